@@ -150,7 +150,10 @@ if len(sys.argv) > 1:
             'presets':presets,
             'config':config}
 
-    amgpplt.init(pack, sys.argv[1])
+    if sys.argv[1] == "--serve":
+        amgpplt.Serve(pack, sys.argv[2] if len(sys.argv) > 2 else config.get("serve", {}).get("address", "8765"))
+    else:
+        amgpplt.init(pack, sys.argv[1])
     
 else:
     # Version handler
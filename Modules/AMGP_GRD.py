@@ -10,6 +10,7 @@
 #                                              #
 ################################################
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from io import StringIO
 from urllib.request import urlopen
@@ -20,6 +21,11 @@ from metpy.plots import declarative
 from metpy.units import units
 import metpy.calc as mpcalc
 import os
+import hashlib
+import json
+import threading
+import contextlib
+import time
 import pandas as pd
 import numpy as np
 import xarray as xr
@@ -85,13 +91,14 @@ def Retrieve(Time, factors, values, LocalData=None):
         timesfc = Time.threetime
         timeua = Time.twelvetime
     
-    Data = FetchData(Time, level, int(values['delta']), LocalData)
+    Data = FetchData(Time, level, int(values['delta']), LocalData, "600", values.get('extent'), Needs(factors, level), values.get('levels'))
+    grd = Data.View()
     
     if level != 'surface':
             
         if "thickness_500_1000" in factors:
             thickness_500_1000 = declarative.ContourPlot()
-            thickness_500_1000.data = Data.grd
+            thickness_500_1000.data = grd
             thickness_500_1000.field = 'thickness_500_1000'
             thickness_500_1000.level = None
             thickness_500_1000.time = None
@@ -103,7 +110,7 @@ def Retrieve(Time, factors, values, LocalData=None):
 
         if "wind_contours" in factors:
             wind_contours = declarative.ContourPlot()
-            wind_contours.data = Data.grd
+            wind_contours.data = grd
             wind_contours.field = 'wind_speed_isobaric'
             wind_contours.level = None
             wind_contours.time = None
@@ -117,7 +124,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "height_contours" in factors:
             pressure_heights = declarative.ContourPlot()
-            pressure_heights.data = Data.grd
+            pressure_heights.data = grd
             pressure_heights.field = 'Geopotential_height_isobaric'
             pressure_heights.level = level * units.hPa
             if Data.recent:
@@ -131,7 +138,7 @@ def Retrieve(Time, factors, values, LocalData=None):
     
         if "temp_contours" in factors:
             temp_contours = declarative.ContourPlot()
-            temp_contours.data = Data.grd
+            temp_contours.data = grd
             temp_contours.field = 'Temperature_isobaric'
             temp_contours.level = level * units.hPa
             if Data.recent:
@@ -147,12 +154,8 @@ def Retrieve(Time, factors, values, LocalData=None):
             partialPlotsList.append(temp_contours)
 
         if "dew_contours" in factors:
-            hPaLevel = level * units.hPa
-            tmpIsoSel = Data.grd['Temperature_isobaric'].metpy.sel(vertical=hPaLevel)
-            rhIsoSel = Data.grd['Relative_humidity_isobaric'].metpy.sel(vertical=hPaLevel)
-            Data.grd['Dewpoint_isobaric'] = mpcalc.dewpoint_from_relative_humidity(tmpIsoSel, rhIsoSel)
             dew_contours = declarative.ContourPlot()
-            dew_contours.data = Data.grd
+            dew_contours.data = grd
             dew_contours.field = 'Dewpoint_isobaric'
             dew_contours.level = None
             if Data.recent:
@@ -164,12 +167,12 @@ def Retrieve(Time, factors, values, LocalData=None):
             dew_contours.linestyle = 'dashed'
             dew_contours.clabels = True
             #dew_contours.plot_units = 'degC'
-            dew_contours.smooth_contours = int(values['smoothing'])
+            dew_contours.smooth_contour = int(values['smoothing'])
             partialPlotsList.append(dew_contours)
         
         if "cape_contours" in factors:
             cape_contours = declarative.ContourPlot()
-            cape_contours.data = Data.grd
+            cape_contours.data = grd
             cape_contours.field = 'Convective_available_potential_energy_surface'
             cape_contours.level = None
             if Data.recent:
@@ -185,7 +188,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "cin_contours" in factors:
             cin_contours = declarative.ContourPlot()
-            cin_contours.data = Data.grd
+            cin_contours.data = grd
             cin_contours.field = 'Convective_inhibition_surface'
             cin_contours.level = None
             if Data.recent:
@@ -201,7 +204,7 @@ def Retrieve(Time, factors, values, LocalData=None):
         
         if "gridded_barbs" in factors:
             barbs = declarative.BarbPlot()
-            barbs.data = Data.grd
+            barbs.data = grd
             if Data.recent:
                 barbs.time = Data.time + timedelta(hours=int(values['delta']))
             else:
@@ -215,7 +218,7 @@ def Retrieve(Time, factors, values, LocalData=None):
     else:   
         if "thickness_500_1000" in factors:
             thickness_500_1000 = declarative.ContourPlot()
-            thickness_500_1000.data = Data.grd
+            thickness_500_1000.data = grd
             thickness_500_1000.field = 'thickness_500_1000'
             thickness_500_1000.level = None
             thickness_500_1000.time = None
@@ -227,7 +230,7 @@ def Retrieve(Time, factors, values, LocalData=None):
 
         if "pressure_contours" in factors:
             pressure = declarative.ContourPlot()
-            pressure.data = Data.grd
+            pressure.data = grd
             pressure.field = 'Pressure_reduced_to_MSL_msl'
             pressure.level = None
             if Data.recent:
@@ -242,7 +245,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "temp_contours" in factors:
             temp_contours = declarative.ContourPlot()
-            temp_contours.data = Data.grd
+            temp_contours.data = grd
             temp_contours.field = 'Temperature_height_above_ground'
             temp_contours.level = 2 * units.m
             if Data.recent:
@@ -259,7 +262,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "dew_contours" in factors:
             dew_contours = declarative.ContourPlot()
-            dew_contours.data = Data.grd
+            dew_contours.data = grd
             dew_contours.field = 'Dewpoint_temperature_height_above_ground'
             dew_contours.level = 2 * units.m
             if Data.recent:
@@ -276,7 +279,7 @@ def Retrieve(Time, factors, values, LocalData=None):
         
         if "cape_contours" in factors:
             cape_contours = declarative.ContourPlot()
-            cape_contours.data = Data.grd
+            cape_contours.data = grd
             cape_contours.field = 'Convective_available_potential_energy_surface'
             cape_contours.level = None
             if Data.recent:
@@ -292,7 +295,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "cin_contours" in factors:
             cin_contours = declarative.ContourPlot()
-            cin_contours.data = Data.grd
+            cin_contours.data = grd
             cin_contours.field = 'Convective_inhibition_surface'
             cin_contours.level = None
             if Data.recent:
@@ -308,7 +311,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "gridded_barbs" in factors:
             barbs = declarative.BarbPlot()
-            barbs.data = Data.grd
+            barbs.data = grd
             if Data.recent:
                 barbs.time = Data.time + timedelta(hours=int(values['delta']))
             else:
@@ -319,73 +322,614 @@ def Retrieve(Time, factors, values, LocalData=None):
             barbs.plot_units = 'knot'
             partialPlotsList.append(barbs)
     
+    with Data.lock:
+        Smooth(Data, partialPlotsList, grd)
+        Transfer(Data, partialPlotsList)
+    
     return partialPlotsList
 
+# Finds the model run time and the candidate locations of the gridded data for a map, in the order they should be tried.
+# tag is the LDS identifier of the requesting module.
+def Sources(Time, delta, LocalData, tag="600"):
+    if (Time.category == 'sync') or (Time.category == 'raw') or (Time.category == 'near'):
+        runTime = Time.time
+    else:
+        runTime = Time.sixtime
+    
+    recent = False
+    sources = []
+    
+    if LocalData != None:
+        for Dataset in LocalData.items():
+            if tag in Dataset[1]:
+                sources = [Dataset[0]]
+    else:
+        if (Time.recentness < timedelta(days=14)):
+            sources = [f'https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_onedeg/GFS_Global_onedeg_{runTime:%Y%m%d}_{runTime:%H%M}.grib2']
+            recent = True
+        elif (runTime >= datetime(2004, 3, 2)):
+            # More recent model data, from Oct 2022 to roughly 3 days prior to present; goes out to 384 hours.
+            # Slightly older model data, from Mar 2003 to May 2020; goes out to 6 hours.
+            # Intermediate data, from June 2016 to May 2020; forecast hours unknown.
+            sources = [f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files/{runTime:%Y%m/%Y%m%d}/gfs_3_{runTime:%Y%m%d_%H}00_{delta:03d}.grb2',
+                       f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-g3-anl-files-old/{runTime:%Y%m/%Y%m%d}/gfsanl_3_{runTime:%Y%m%d_%H}00_000.grb',
+                       f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-g3-anl-files-old/{runTime:%Y%m/%Y%m%d}/gfsanl_3_{runTime:%Y%m%d_%H}00_000.grb2',
+                       f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files-old/{runTime:%Y%m/%Y%m%d}/gfs_3_{runTime:%Y%m%d_%H}00_{delta:03d}.grb2']
+        elif (runTime >= datetime(1979, 1, 1)):
+            sources = [f'https://www.ncei.noaa.gov/thredds/dodsC/model-narr-a-files/{runTime:%Y%m/%Y%m%d}/narr-a_221_{runTime:%Y%m%d_%H}00_000.grb',
+                       f'https://www.ncei.noaa.gov/thredds/dodsC/model-narr-a-files/{runTime:%Y%m/%Y%m%d}/narr-a_221_{runTime:%Y%m%d_%H}00_000.grb2']
+    
+    return runTime, recent, sources
+
+# Crops a lazily-opened dataset to the padded map extent, the isobaric levels a map can use, and the valid time(s),
+# so that OPeNDAP only transfers that hyperslab when the values are read.
+def Subset(grd, extent, level, valid):
+    if type(valid) != list:
+        valid = [valid]
+    valid = [np.datetime64(time) for time in valid]
+    
+    if level == 'surface':
+        levels = [500, 1000]
+    else:
+        levels = [level, 500, 1000] if type(level) != tuple else [*level, 500, 1000]
+    
+    for dim in list(grd.dims):
+        if dim.startswith('isobaric'):
+            hPa = (grd[dim].values * units(grd[dim].attrs.get('units', 'hPa'))).m_as('hPa')
+            grd = grd.isel({dim: np.flatnonzero(np.isin(np.round(hPa), levels))})
+        elif dim.startswith('time'):
+            present = [time for time in valid if time in grd[dim].values]
+            if len(present) > 0:
+                grd = grd.sel({dim: present})
+    
+    if (type(extent) == tuple) and ('lat' in grd.coords) and ('lon' in grd.coords) and (grd['lat'].ndim == 1) and (grd['lon'].ndim == 1):
+        grd = Crop(grd, extent)
+    
+    return grd
+
+# Crops to the padded extent by index, whichever way the grid runs and whether its longitudes are -180 to 180 or 0 to
+# 360. An area across the grid's seam is pulled as two pieces joined with continuous longitudes; a box that cannot be
+# cut as that is left uncropped.
+def Crop(grd, extent):
+    lats, lons = amgp.DataArea(extent)
+    lat = grd['lat'].values
+    latRuns = amgp.Runs((lat >= lats[0]) & (lat <= lats[1]))
+    if len(latRuns) != 1:
+        return grd
+    if lons is None:
+        return grd.isel(lat=latRuns[0])
+    
+    lon = grd['lon'].values
+    lonRuns = amgp.Runs(((lon - lons[0]) % 360) <= lons[1])
+    if len(lonRuns) == 1:
+        return grd.isel(lat=latRuns[0], lon=lonRuns[0])
+    if (len(lonRuns) != 2) or (lonRuns[0].start != 0) or (lonRuns[1].stop != len(lon)):
+        return grd
+    
+    # The area runs from the end of the longitudes round to their start
+    tail = grd.isel(lat=latRuns[0], lon=lonRuns[1])
+    head = grd.isel(lat=latRuns[0], lon=lonRuns[0])
+    if tail['lon'].values[0] > head['lon'].values[-1]:
+        tail = tail.assign_coords(lon=tail['lon'] - 360)
+    return xr.concat([tail, head], dim='lon', data_vars='minimal', coords='minimal', compat='override')
+
+transferred = {'bytes':0, 'full':0}
+transferLock = threading.Lock()
+
+# Estimates how much a map's layers read from a dataset, against what the uncropped fields would have been. The
+# estimate is the in-memory size of the decoded, float32 fields, not a count of the bytes that crossed the network.
+def Transfer(Data, plots, module="AMGP_GRD"):
+    if Data.grd is None:
+        return
+    fields = set(Data.inputs)
+    for plot in plots:
+        field = getattr(plot, 'field', None)
+        if type(field) == str:
+            fields.add(field)
+        elif field is not None:
+            fields.update(field)
+    new = [field for field in fields if (field in Data.full) and (field not in Data.counted)]
+    subsetBytes = sum(Data.grd[field].nbytes for field in new)
+    fullBytes = sum(Data.full[field] for field in new)
+    Data.counted.update(new)
+    with transferLock:
+        transferred['bytes'] += subsetBytes
+        transferred['full'] += fullBytes
+        session = transferred['bytes']
+    print(f"({module}) <fetch> Read an estimated {subsetBytes / 1024:.0f} KB of gridded data ({fullBytes / 1024:.0f} KB uncropped, as decoded); about {session / 1024**2:.1f} MB this session")
+
+# Smooths each contoured field once per (field, level, time, smoothing) ahead of rendering, so that every layer and map
+# drawing that field shares the result instead of zooming it again as it is drawn. grd is the view the plots were given.
+def Smooth(Data, plots, grd=None):
+    if grd is None:
+        grd = Data.grd
+    held = len(Data.smoothed)
+    for plot in plots:
+        factor = getattr(plot, 'smooth_contour', None)
+        if (not factor) or (type(plot.field) != str) or (plot.data is not grd):
+            continue
+        smoothed = Data.Smoothed(plot.field, plot.level, plot.time, factor)
+        if smoothed is not None:
+            plot.data = smoothed
+            plot.level = None
+            plot.time = None
+            plot.smooth_contour = None
+    
+    # The cached entry is measured again, so that its smoothed fields count against the gridded budget
+    if len(Data.smoothed) > held:
+        cache = amgp.GetCache("gridded", lambda data: data.Size())
+        if cache.Get(Data.key) is Data:
+            cache.Put(Data.key, Data)
+
+# The variables each gridded factor reads, as [surface, upper-air]; derived variables are computed from their inputs on demand.
+fields = {'height_contours':[[], ['Geopotential_height_isobaric']],
+          'wind_contours':[[], ['wind_speed_isobaric']],
+          'temp_contours':[['Temperature_height_above_ground'], ['Temperature_isobaric']],
+          'pressure_contours':[['Pressure_reduced_to_MSL_msl'], []],
+          'dew_contours':[['Dewpoint_temperature_height_above_ground'], ['Dewpoint_isobaric']],
+          'thickness_500_1000':[['thickness_500_1000'], ['thickness_500_1000']],
+          'gridded_barbs':[['u-component_of_wind_height_above_ground', 'v-component_of_wind_height_above_ground'], ['u-component_of_wind_isobaric', 'v-component_of_wind_isobaric']],
+          'cape_contours':[['Convective_available_potential_energy_surface'], ['Convective_available_potential_energy_surface']],
+          'cin_contours':[['Convective_inhibition_surface'], ['Convective_inhibition_surface']],
+          'temp_fill':[['Temperature_height_above_ground'], ['Temperature_isobaric']],
+          'snow_temp_fill':[['air'], ['air']],
+          'snow_temp_contours':[['air'], ['air']],
+          'wind_speed_fill':[['wind_speed_height_above_ground'], ['wind_speed_isobaric']],
+          'temp_advect_fill':[['temperature_advection'], ['temperature_advection']],
+          'relative_vorticity_fill':[['relative_vorticity'], ['relative_vorticity']],
+          'absolute_vorticity_fill':[[], ['Absolute_vorticity_isobaric']],
+          'cape_fill':[['Convective_available_potential_energy_surface'], ['Convective_available_potential_energy_surface']],
+          'cin_fill':[['Convective_inhibition_surface'], ['Convective_inhibition_surface']]}
+
+def Needs(factors, level):
+    needs = []
+    for factor in factors:
+        if factor in fields:
+            for name in fields[factor][0 if level == 'surface' else 1]:
+                if name not in needs:
+                    needs.append(name)
+    return needs
+
+def WindSpeed(Data, u, v):
+    return mpcalc.wind_speed(Data.Select(u), Data.Select(v))
+
+def Vorticity(Data, u, v):
+    return mpcalc.vorticity(Data.Select(u), Data.Select(v))
+
+def Advection(Data, t, u, v):
+    return mpcalc.advection(Data.Select(t), Data.Select(u), Data.Select(v))
+
+def Thickness(Data, z):
+    hght_500 = Data.grd[z].metpy.sel(time=Data.valid, vertical=500 * units.hPa).metpy.quantify()
+    hght_1000 = Data.grd[z].metpy.sel(time=Data.valid, vertical=1000 * units.hPa).metpy.quantify()
+    return (hght_500 - hght_1000).metpy.dequantify()
+
+def Dewpoint(Data, t, rh):
+    return mpcalc.dewpoint_from_relative_humidity(Data.Select(t), Data.Select(rh))
+
+# Derived variables, as [surface inputs, upper-air inputs, function]; the function is given the dataset and its inputs.
+derived = {'wind_speed_height_above_ground':[['u-component_of_wind_height_above_ground', 'v-component_of_wind_height_above_ground'], None, WindSpeed],
+           'wind_speed_isobaric':[None, ['u-component_of_wind_isobaric', 'v-component_of_wind_isobaric'], WindSpeed],
+           'relative_vorticity':[['u-component_of_wind_height_above_ground', 'v-component_of_wind_height_above_ground'], ['u-component_of_wind_isobaric', 'v-component_of_wind_isobaric'], Vorticity],
+           'temperature_advection':[['Temperature_height_above_ground', 'u-component_of_wind_height_above_ground', 'v-component_of_wind_height_above_ground'], ['Temperature_isobaric', 'u-component_of_wind_isobaric', 'v-component_of_wind_isobaric'], Advection],
+           'thickness_500_1000':[['Geopotential_height_isobaric'], ['Geopotential_height_isobaric'], Thickness],
+           'Dewpoint_isobaric':[None, ['Temperature_isobaric', 'Relative_humidity_isobaric'], Dewpoint]}
+
+def Inputs(name, level):
+    if name not in derived:
+        return [name]
+    inputs = derived[name][0 if level == 'surface' else 1]
+    if inputs == None:
+        return []
+    return inputs
+
+# The raw variables that must be pulled to produce the given variables
+def Raw(names, level):
+    raw = []
+    for name in names:
+        for item in Inputs(name, level):
+            if item not in raw:
+                raw.append(item)
+    return raw
+
+# Only the variables a map needs are kept from the hundreds a model dataset exposes, along with their grid mappings.
+# Older archives name geopotential height 'hgt'.
+def Prune(remote, names):
+    keep = []
+    for name in names:
+        if (name == 'Geopotential_height_isobaric') and (name not in remote) and ('hgt' in remote):
+            name = 'hgt'
+        if name not in remote:
+            continue
+        keep.append(name)
+        mapping = remote[name].attrs.get('grid_mapping')
+        if (mapping != None) and (mapping in remote) and (mapping not in keep):
+            keep.append(mapping)
+    remote = remote[keep]
+    if 'hgt' in remote:
+        remote = remote.rename({'hgt': 'Geopotential_height_isobaric'})
+    return remote
+
+# Model fields are held as float32, which is all the precision a map needs and half the memory of float64
+def Float32(grd):
+    if isinstance(grd, xr.Dataset):
+        return grd.map(Float32, keep_attrs=True)
+    if grd.dtype == np.float64:
+        return grd.astype(np.float32)
+    return grd
+
+def OpenSource(source):
+    if "narr" in source:
+        return xr.open_dataset(source).metpy.parse_cf().metpy.assign_latitude_longitude()
+    return xr.open_dataset(source).metpy.parse_cf()
+
+# The archive a source URL belongs to, e.g. 'model-gfs-003-files.grb2'
+def Archive(source):
+    return source.split('/dodsC/')[-1].split('/')[0] + os.path.splitext(source)[1]
+
+# Which archive held the data for each month, kept on disk so that later maps of the same period go straight to it
+archives = None
+archiveLock = threading.Lock()
+
+def ArchivePath():
+    return f"{amgp.CacheDir('gridded')}/archives.json"
+
+def KnownArchive(runTime):
+    global archives
+    with archiveLock:
+        if archives is None:
+            try:
+                with open(ArchivePath(), "r") as J:
+                    archives = json.load(J)
+            except:
+                archives = {}
+        return archives.get(f"{runTime:%Y%m}")
+
+def RecordArchive(runTime, source):
+    with archiveLock:
+        if archives.get(f"{runTime:%Y%m}") == Archive(source):
+            return
+        archives[f"{runTime:%Y%m}"] = Archive(source)
+        try:
+            with open(f"{ArchivePath()}.tmp", "w") as J:
+                json.dump(archives, J, indent=4)
+            os.replace(f"{ArchivePath()}.tmp", ArchivePath())
+        except:
+            print("(AMGP_GRD) <warning> The archive index could not be written to the local cache")
+
+# Whether an opened dataset has the given valid time(s); datasets without a time coordinate are taken as they are
+def Holds(remote, valid):
+    if valid is None:
+        return True
+    if type(valid) != list:
+        valid = [valid]
+    times = set()
+    for name, coord in remote.coords.items():
+        if name.startswith('time') and np.issubdtype(coord.dtype, np.datetime64):
+            times.update(coord.values.astype('datetime64[ns]').astype('int64').ravel().tolist())
+    if len(times) == 0:
+        return True
+    return all(int(np.datetime64(time, 'ns').astype('int64')) in times for time in valid)
+
+# Opens the first of the given sources that works and holds the valid time(s). The lazily-opened datasets are kept, so
+# that every map made from the same run (the recent GFS has one URL per run, not per forecast hour) reuses a single
+# metadata round-trip. When there are several archives to choose from, the one known to hold the month is tried
+# first, and the rest are probed all at once rather than waiting out each failure in turn, though the earliest source
+# that works is still the one taken, as it would be trying them in order.
+def OpenRemote(sources, runTime=None, valid=None):
+    handles = amgp.GetCache("handles", lambda remote: 1024**2)
+    
+    # The cache is not held while a source opens, so that concurrent probes and retrievals are not queued behind it. A
+    # kept handle that lacks the hour may predate it, as while a recent run is still being uploaded, so it is reopened once.
+    def Probe(source):
+        remote = handles.Get(source)
+        if (remote is not None) and not Holds(remote, valid):
+            handles.Drop(source)
+            with contextlib.suppress(Exception):
+                remote.close()
+            remote = None
+        if remote is None:
+            remote = OpenSource(source)
+            handles.Put(source, remote)
+        if not Holds(remote, valid):
+            raise LookupError(f"{source} does not hold the valid time")
+        return source, remote
+    
+    if (runTime is None) or (len(sources) < 2):
+        for source in sources:
+            try:
+                return Probe(source)
+            except:
+                continue
+        return None, None
+    
+    known = KnownArchive(runTime)
+    candidates = list(sources)
+    for source in sources:
+        if Archive(source) == known:
+            try:
+                return Probe(source)
+            except:
+                candidates.remove(source)
+    
+    pool = ThreadPoolExecutor(max_workers=max(len(candidates), 1))
+    try:
+        for future in [pool.submit(Probe, source) for source in candidates]:
+            try:
+                source, remote = future.result()
+            except:
+                continue
+            RecordArchive(runTime, source)
+            return source, remote
+    finally:
+        pool.shutdown(wait=False)
+    return None, None
+
 class Data(object):
-    def __init__(self, Time, level, delta, LocalData):
-        
-        self.recent = False
+    def __init__(self, runTime, recent, sources, level, delta, local=False, extent=None, grd=None):
         
-        if (Time.category == 'sync') or (Time.category == 'raw') or (Time.category == 'near'):
-            self.time = Time.time
-        else:
-            self.time = Time.sixtime
-
-        #self.grd = xr.open_dataset("reanalysis_jan1996.nc")
+        self.recent = recent
+        self.time = runTime
+        self.valid = runTime + timedelta(hours=delta)
+        self.sources = sources
+        self.level = level
+        self.delta = delta
+        self.extent = extent
+        self.local = local
+        self.key = (tuple(sources), runTime, delta, level, extent)
+        self.grd = None
+        self.source = None
+        self.disk = None
+        self.stored = set()
+        self.full = {}
+        self.inputs = []
+        self.counted = set()
+        self.failed = set()
+        self.smoothed = {}
+        self.unavailable = False
+        self.retry = None
+        self.lock = threading.RLock()
 
-        if LocalData != None:
-            for Dataset in LocalData.items():
-                if "600" in Dataset[1]:
-                    self.grd = xr.open_dataset(Dataset[0])
+        if grd is not None:
+            self.grd = grd
+            self.source = sources[0]
+            self.disk = DiskPath(sources, runTime, delta, level, extent)
+        elif local:
+            for source in sources:
+                self.grd = xr.open_dataset(source)
+                self.source = source
+        elif len(sources) == 0:
+            print("(AMGP_GRD) <warning> The date you have selected has no gridded data available!")
+            self.unavailable = True
         else:
-            if (Time.recentness < timedelta(days=14)):
-                self.grd = xr.open_dataset(f'https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_onedeg/GFS_Global_onedeg_{self.time:%Y%m%d}_{self.time:%H%M}.grib2').metpy.parse_cf()
-                self.recent = True
-            elif (self.time >= datetime(2004, 3, 2)):
+            # The on-disk cache is checked before anything remote is opened
+            self.disk = DiskPath(sources, runTime, delta, level, extent)
+            if os.path.isfile(self.disk):
                 try:
-                    # More recent model data, from Oct 2022 to roughly 3 days prior to present; goes out to 384 hours.
-                    self.grd = xr.open_dataset(f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files/{self.time:%Y%m/%Y%m%d}/gfs_3_{self.time:%Y%m%d_%H}00_{delta:03d}.grb2').metpy.parse_cf()
+                    self.grd = xr.load_dataset(self.disk).metpy.parse_cf()
+                    self.stored = set(self.grd.data_vars)
+                    self.source = self.disk
+                    amgp.TouchDisk(self.disk)
                 except:
-                    try:
-                        # Slightly older model data, from Mar 2003 to May 2020; goes out to 6 hours.
-                        self.grd = xr.open_dataset(f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-g3-anl-files-old/{self.time:%Y%m/%Y%m%d}/gfsanl_3_{self.time:%Y%m%d_%H}00_000.grb').metpy.parse_cf()
-                    except:
-                        try:
-                            # Intermediate data, from June 2016 to May 2020; forecast hours unknown.
-                            self.grd = xr.open_dataset(f'https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files-old/{self.time:%Y%m/%Y%m%d}/gfs_3_{self.time:%Y%m%d_%H}00_{delta:03d}.grb2').metpy.parse_cf()
-                        except:
-                            print("(AMGP_GRD) <warning> Gridded data could not be found for the date you have selected!")
-                            self.grd = None
-            elif (self.time >= datetime(1979, 1, 1)):
-                self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-narr-a-files/'f'{self.time:%Y%m/%Y%m%d}/narr-a_221_{self.time:%Y%m%d_%H}00_000.grb2').metpy.parse_cf().metpy.assign_latitude_longitude()
-            else:
-                print("(AMGP_GRD) <warning> The date you have selected has no gridded data available!")
-                self.grd = None
-        try:
-            if level == 'surface':
-                tmpk = self.grd.Temperature_height_above_ground.metpy.sel(vertical=2*units.m, time=self.time + timedelta(hours=delta))
-                uwind = self.grd['u-component_of_wind_height_above_ground'].metpy.sel(vertical=10*units.m, time=self.time + timedelta(hours=delta))
-                vwind = self.grd['v-component_of_wind_height_above_ground'].metpy.sel(vertical=10*units.m, time=self.time + timedelta(hours=delta))
-                self.grd['wind_speed_height_above_ground'] = mpcalc.wind_speed(uwind, vwind)
-            else:
-                tmpk = self.grd.Temperature_isobaric.metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                uwind = self.grd['u-component_of_wind_isobaric'].metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                vwind = self.grd['v-component_of_wind_isobaric'].metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                self.grd['wind_speed_isobaric'] = mpcalc.wind_speed(uwind, vwind)
-            self.grd['relative_vorticity'] = mpcalc.vorticity(uwind, vwind)
-            self.grd['temperature_advection'] = mpcalc.advection(tmpk, uwind, vwind)
-            hght_500 = self.grd.Geopotential_height_isobaric.metpy.sel(time=self.time + timedelta(hours=delta), vertical=500 * units.hPa).metpy.quantify()
-            hght_1000 = self.grd.Geopotential_height_isobaric.metpy.sel(time=self.time + timedelta(hours=delta), vertical=1000 * units.hPa).metpy.quantify()
-            self.grd['thickness_500_1000'] = (hght_500 - hght_1000).metpy.dequantify()
-        except:
-            print("(AMGP_GRD) <warning> Derived variables could not be calculated using the current dataset(s)")
+                    self.grd = None
 
         try:
             self.grd["Geopotential_height_isobaric"] = self.grd["hgt"]
             self.Converted = "hgt"
         except:
             self.Converted = None
+    
+    # A raw variable at this map's level and valid time; surface temperatures are at 2m and surface winds at 10m
+    def Select(self, name):
+        if name.endswith('height_above_ground'):
+            if name.startswith('Temperature'):
+                return self.grd[name].metpy.sel(vertical=2*units.m, time=self.valid)
+            return self.grd[name].metpy.sel(vertical=10*units.m, time=self.valid)
+        return self.grd[name].metpy.sel(vertical=self.level*units.hPa, time=self.valid)
+    
+    # Computes the derived variables among the given names that have not been computed for this dataset yet
+    def Derive(self, names):
+        for name in names:
+            if (name not in derived) or (self.grd is None) or (name in self.grd) or (name in self.failed):
+                continue
+            inputs = Inputs(name, self.level)
+            try:
+                self.grd[name] = Float32(derived[name][2](self, *inputs))
+                self.inputs.extend([item for item in inputs if item not in self.inputs])
+            except:
+                self.failed.add(name)
+                print(f"(AMGP_GRD) <warning> The derived variable '{name}' could not be calculated using the current dataset(s)")
+    
+    # The dataset as it is now, for plots to read while other maps keep filling in the cached one
+    def View(self):
+        with self.lock:
+            if self.grd is None:
+                return None
+            return self.grd.copy(deep=False)
+    
+    # What the dataset holds in memory, counting the smoothed fields made from it
+    def Size(self):
+        size = self.grd.nbytes if self.grd is not None else 0
+        return size + sum(item.nbytes for item in self.smoothed.values() if item is not None)
+    
+    # A field at one level and time, smoothed the way declarative's smooth_contour would, as its own dataset
+    def Smoothed(self, field, level, time, factor):
+        key = (field, level, time, factor)
+        if key not in self.smoothed:
+            try:
+                data = self.grd[field]
+                subset = {'method': 'nearest'}
+                if level is not None:
+                    subset[data.metpy.vertical.name] = level
+                if time is not None:
+                    subset[data.metpy.time.name] = time
+                data = data.metpy.sel(**subset).squeeze()
+                self.smoothed[key] = mpcalc.zoom_xarray(data, factor).to_dataset(name=field)
+            except:
+                self.smoothed[key] = None
+        return self.smoothed[key]
+    
+    # Opens the first remote source that works, pruned to the given variables and cropped to this map
+    def Open(self, names):
+        source, remote = OpenRemote(self.sources, self.time, self.valid)
+        if remote is None:
+            return None
+        self.source = source
+        self.full = {name: var.nbytes for name, var in remote.data_vars.items()}
+        return Subset(Prune(remote, names), self.extent, self.level, self.valid)
+    
+    # Makes sure the given raw variables are available, pulling any that the on-disk cache lacks, and storing them back to it
+    def Require(self, names):
+        if self.local or self.unavailable:
+            return
+        missing = [name for name in names if (self.grd is None) or (name not in self.grd)]
+        if len(missing) > 0:
+            # A failed pull is only trusted for a few minutes; the entry may outlive an outage, as in the daemon
+            if (self.retry is not None) and (time.monotonic() < self.retry):
+                return
+            remote = self.Open(missing)
+            if remote is None:
+                print("(AMGP_GRD) <warning> Gridded data could not be found for the date you have selected!")
+                self.retry = time.monotonic() + 300
+                return
+            self.retry = None
+            remote = Float32(remote.load())
+            if self.grd is None:
+                self.grd = remote
+            else:
+                for name in remote.data_vars:
+                    self.grd[name] = remote[name]
+        self.Store([name for name in names if name in self.grd])
+    
+    def Store(self, names):
+        if (self.disk is None) or (self.grd is None) or set(names).issubset(self.stored):
+            return
+        keep = list(names)
+        for name in names:
+            mapping = self.grd[name].attrs.get('grid_mapping')
+            if (mapping != None) and (mapping in self.grd) and (mapping not in keep):
+                keep.append(mapping)
+        try:
+            subset = self.grd[keep].load().drop_vars('metpy_crs', errors='ignore')
+            if os.path.isfile(self.disk):
+                subset = xr.merge([xr.load_dataset(self.disk), subset], compat='override')
+            subset.to_netcdf(f"{self.disk}.tmp")
+            os.replace(f"{self.disk}.tmp", self.disk)
+            self.stored = set(subset.data_vars)
+            amgp.TrimDisk(self.disk)
+        except:
+            print("(AMGP_GRD) <warning> Gridded data could not be written to the local cache")
+
+def DiskPath(sources, runTime, delta, level, extent):
+    digest = hashlib.md5(repr((tuple(sources), runTime, delta, level, extent)).encode()).hexdigest()[:12]
+    if type(level) == tuple:
+        level = '-'.join(map(str, level))
+    return f"{amgp.CacheDir('gridded')}/{runTime:%Y%m%d%H}_{delta:03d}_{level}_{digest}.nc"
+        
+
+# Shared by AMGP_GRD and AMGP_GRDF, so that a map with both contours and fills opens and derives each dataset once.
+# levels lists every level being mapped from the same settings; the isobaric ones are then pulled together as one cube.
+def FetchData(Time, level, delta, LocalData, tag="600", extent=None, needs=[], levels=None):
+    runTime, recent, sources = Sources(Time, delta, LocalData, tag)
+    key = (tuple(sources), runTime, delta, level, extent)
+    cache = amgp.GetCache("gridded", lambda data: data.Size())
+    
+    # The cube is only worth pulling when this level is neither held nor on disk, e.g. not already prefetched
+    cube = None
+    held = (cache.Get(key) is not None) or ((len(sources) > 0) and os.path.isfile(DiskPath(sources, runTime, delta, level, extent)))
+    if (levels != None) and (level != 'surface') and (LocalData == None) and not held:
+        isobaric = tuple(sorted(set(item for item in levels if item != 'surface')))
+        if (len(isobaric) > 1) and (level in isobaric):
+            cube = FetchCube(Time, isobaric, delta, tag, extent, needs)
+    with cache.Locked(key):
+        data = cache.Fetch(key, lambda: Data(runTime, recent, sources, level, delta, LocalData != None, extent, Cut(cube, level)))
+    with data.lock:
+        data.Require(Raw(needs, level))
+        data.Derive(needs)
+        if data.grd is None:
+            cache.Drop(key)
+        else:
+            cache.Put(key, data)
+    return data
+
+# Several isobaric levels of one map time are pulled together, and each level's dataset is cut from the cube
+def FetchCube(Time, levels, delta, tag, extent, needs):
+    runTime, recent, sources = Sources(Time, delta, None, tag)
+    raw = []
+    for level in levels:
+        raw.extend([name for name in Raw(needs, level) if name not in raw])
+    key = (tuple(sources), runTime, delta, levels, extent)
+    cache = amgp.GetCache("gridded", lambda data: data.Size())
+    with cache.Locked(key):
+        data = cache.Fetch(key, lambda: Data(runTime, recent, sources, levels, delta, False, extent))
+    with data.lock:
+        data.Require(raw)
+        if data.grd is None:
+            cache.Drop(key)
+        else:
+            cache.Put(key, data)
+    return data
+
+def Cut(cube, level):
+    if (cube is None) or (cube.grd is None):
+        return None
+    return Subset(cube.grd, None, level, cube.valid)
+
+# Pulls several forecast hours of one model run in a single vectorized slice, and hands each hour to the gridded cache
+# under the key FetchData will look for, so a delta loop opens the run and reads each variable once.
+def FetchRun(Time, level, deltas, LocalData, tag="600", extent=None, needs=[]):
+    if LocalData != None:
+        return
+    cache = amgp.GetCache("gridded", lambda data: data.Size())
+    raw = Raw(needs, level)
+    
+    groups = {}
+    for delta in deltas:
+        runTime, recent, sources = Sources(Time, delta, LocalData, tag)
+        if len(sources) > 0:
+            groups.setdefault(tuple(sources), []).append(delta)
+    
+    for sources, group in groups.items():
+        if len(group) < 2:
+            continue
+        frames = {}
+        missing = []
+        for delta in group:
+            frames[delta] = cache.Get((sources, runTime, delta, level, extent))
+            if (frames[delta] is None) and os.path.isfile(DiskPath(sources, runTime, delta, level, extent)):
+                frames[delta] = Data(runTime, recent, list(sources), level, delta, False, extent)
+                if frames[delta].grd is None:
+                    frames[delta] = None
+                else:
+                    cache.Put((sources, runTime, delta, level, extent), frames[delta])
+            for name in raw:
+                if ((frames[delta] is None) or (name not in frames[delta].grd)) and (name not in missing):
+                    missing.append(name)
+        if len(missing) == 0:
+            continue
+        
+        valids = [runTime + timedelta(hours=delta) for delta in group]
+        source, remote = OpenRemote(list(sources), runTime, valids)
+        if remote is None:
+            continue
+        multi = Float32(Subset(Prune(remote, missing), extent, level, valids).load())
+        print(f"(AMGP_GRD) <fetch> Read an estimated {multi.nbytes / 1024:.0f} KB of gridded data (as decoded) for {len(group)} forecast hours of the {runTime:%Y-%m-%d %H}Z run")
         
+        for delta in group:
+            frame = Subset(multi, None, level, runTime + timedelta(hours=delta))
+            with cache.Locked((sources, runTime, delta, level, extent)):
+                data = cache.Get((sources, runTime, delta, level, extent)) or frames[delta]
+                if data is None:
+                    data = Data(runTime, recent, list(sources), level, delta, False, extent, frame)
+                else:
+                    with data.lock:
+                        if data.grd is None:
+                            data.grd = frame
+                        for name in frame.data_vars:
+                            if name not in data.grd:
+                                data.grd[name] = frame[name]
+                cache.Put((sources, runTime, delta, level, extent), data)
 
-def FetchData(Time, level, delta, LocalData):
-    return Data(Time, level, delta, LocalData)
\ No newline at end of file
+def Prefetch(Time, factors, values, deltas, LocalData=None):
+    level = amgp.GetLevel(values['level']).level
+    FetchRun(Time, level, deltas, LocalData, "600", values.get('extent'), Needs(factors, level))
@@ -25,6 +25,7 @@ import numpy as np
 import xarray as xr
 
 from Modules import AMGP_UTIL as amgp
+from Modules import AMGP_GRD as amgpgrd
 
 #------------------ END IMPORTS -------------------#
 
@@ -75,12 +76,13 @@ def Retrieve(Time, factors, values, LocalData=None):
         timesfc = Time.threetime
         timeua = Time.twelvetime
         
-    Data = FetchData(Time, level, int(values['delta']), LocalData)
+    Data = FetchData(Time, level, int(values['delta']), LocalData, values.get('extent'), amgpgrd.Needs(factors, level), values.get('levels'))
+    grd = Data.View()
     
     if level != 'surface':
         if "snow_temp_fill" in factors:
             snow_temp_fill = declarative.ContourPlot()
-            snow_temp_fill.data = Data.grd
+            snow_temp_fill.data = grd
             snow_temp_fill.field = 'air'
             snow_temp_fill.level = level * units.hPa
             if Data.recent:
@@ -95,7 +97,7 @@ def Retrieve(Time, factors, values, LocalData=None):
 
         if "snow_temp_contours" in factors:
             snow_temp_contours = declarative.ContourPlot()
-            snow_temp_contours.data = Data.grd
+            snow_temp_contours.data = grd
             snow_temp_contours.field = 'air'
             snow_temp_contours.level = level * units.hPa
             if Data.recent:
@@ -110,7 +112,7 @@ def Retrieve(Time, factors, values, LocalData=None):
         
         if "temp_fill" in factors:
             temp_fill = declarative.FilledContourPlot()
-            temp_fill.data = Data.grd
+            temp_fill.data = grd
             temp_fill.field = 'Temperature_isobaric'
             temp_fill.level = level * units.hPa
             if Data.recent:
@@ -125,7 +127,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "wind_speed_fill" in factors:
             wind_speed_fill = declarative.FilledContourPlot()
-            wind_speed_fill.data = Data.grd
+            wind_speed_fill.data = grd
             wind_speed_fill.field = 'wind_speed_isobaric'
             wind_speed_fill.level = None
             wind_speed_fill.time = None
@@ -137,7 +139,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "temp_advect_fill" in factors:
             temp_advect_fill = declarative.FilledContourPlot()
-            temp_advect_fill.data = Data.grd
+            temp_advect_fill.data = grd
             temp_advect_fill.field = 'temperature_advection'
             temp_advect_fill.level = None
             temp_advect_fill.time = None
@@ -150,7 +152,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "relative_vorticity_fill" in factors:
             relative_vorticity_fill = declarative.FilledContourPlot()
-            relative_vorticity_fill.data = Data.grd
+            relative_vorticity_fill.data = grd
             relative_vorticity_fill.field = 'relative_vorticity'
             relative_vorticity_fill.level = None
             relative_vorticity_fill.time = None
@@ -162,7 +164,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "absolute_vorticity_fill" in factors:
             absolute_vorticity_fill = declarative.FilledContourPlot()
-            absolute_vorticity_fill.data = Data.grd
+            absolute_vorticity_fill.data = grd
             absolute_vorticity_fill.field = 'Absolute_vorticity_isobaric'
             absolute_vorticity_fill.level = level * units.hPa
             if Data.recent:
@@ -177,7 +179,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "cape_fill" in factors:
             cape_fill = declarative.FilledContourPlot()
-            cape_fill.data = Data.grd
+            cape_fill.data = grd
             cape_fill.field = 'Convective_available_potential_energy_surface'
             cape_fill.level = None
             if Data.recent:
@@ -191,7 +193,7 @@ def Retrieve(Time, factors, values, LocalData=None):
         
         if "cin_fill" in factors:
             cin_fill = declarative.FilledContourPlot()
-            cin_fill.data = Data.grd
+            cin_fill.data = grd
             cin_fill.field = 'Convective_inhibition_surface'
             cin_fill.level = None
             if Data.recent:
@@ -206,7 +208,7 @@ def Retrieve(Time, factors, values, LocalData=None):
     else:
         if "temp_fill" in factors:
             temp_fill = declarative.FilledContourPlot()
-            temp_fill.data = Data.grd
+            temp_fill.data = grd
             temp_fill.field = 'Temperature_height_above_ground'
             temp_fill.level = 2 * units.m
             if Data.recent:
@@ -217,12 +219,12 @@ def Retrieve(Time, factors, values, LocalData=None):
             temp_fill.colormap = 'coolwarm'
             temp_fill.colorbar = 'horizontal'
             temp_fill.plot_units = 'degF'
-            print(Data.grd.coords.to_dataset())
+            print(grd.coords.to_dataset())
             partialPlotsList.append(temp_fill)
             
         if "wind_speed_fill" in factors:
             wind_speed_fill = declarative.FilledContourPlot()
-            wind_speed_fill.data = Data.grd
+            wind_speed_fill.data = grd
             wind_speed_fill.field = 'wind_speed_height_above_ground'
             wind_speed_fill.level = None
             wind_speed_fill.time = None
@@ -234,7 +236,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "temp_advect_fill" in factors:
             temp_advect_fill = declarative.FilledContourPlot()
-            temp_advect_fill.data = Data.grd
+            temp_advect_fill.data = grd
             temp_advect_fill.field = 'temperature_advection'
             temp_advect_fill.level = None
             temp_advect_fill.time = None
@@ -247,7 +249,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "relative_vorticity_fill" in factors:
             relative_vorticity_fill = declarative.FilledContourPlot()
-            relative_vorticity_fill.data = Data.grd
+            relative_vorticity_fill.data = grd
             relative_vorticity_fill.field = 'relative_vorticity'
             relative_vorticity_fill.level = None
             relative_vorticity_fill.time = None
@@ -259,7 +261,7 @@ def Retrieve(Time, factors, values, LocalData=None):
             
         if "cape_fill" in factors:
             cape_fill = declarative.FilledContourPlot()
-            cape_fill.data = Data.grd
+            cape_fill.data = grd
             cape_fill.field = 'Convective_available_potential_energy_surface'
             cape_fill.level = None
             if Data.recent:
@@ -273,7 +275,7 @@ def Retrieve(Time, factors, values, LocalData=None):
         
         if "cin_fill" in factors:
             cin_fill = declarative.FilledContourPlot()
-            cin_fill.data = Data.grd
+            cin_fill.data = grd
             cin_fill.field = 'Convective_inhibition_surface'
             cin_fill.level = None
             if Data.recent:
@@ -285,70 +287,15 @@ def Retrieve(Time, factors, values, LocalData=None):
             cin_fill.colorbar = 'horizontal'
             partialPlotsList.append(cin_fill)
     
+    with Data.lock:
+        amgpgrd.Smooth(Data, partialPlotsList, grd)
+        amgpgrd.Transfer(Data, partialPlotsList, "AMGP_GRDF")
+    
     return partialPlotsList
 
-class Data(object):
-    def __init__(self, Time, level, delta, LocalData):
-        
-        self.recent = False
-        
-        if (Time.category == 'sync') or (Time.category == 'raw') or (Time.category == 'near'):
-            self.time = Time.time
-        else:
-            self.time = Time.sixtime
-
-        #self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-g3-anl-files-old/201801/20180101/gfsanl_3_20180101_0000_000.grb2').metpy.parse_cf()
-
-        if LocalData != None:
-            for Dataset in LocalData.items():
-                if "1000" in Dataset[1]:
-                    self.grd = xr.open_dataset(Dataset[0])
-        else:
-            if (Time.recentness < timedelta(days=14)):
-                self.grd = xr.open_dataset(f'https://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/Global_onedeg/GFS_Global_onedeg_{self.time:%Y%m%d}_{self.time:%H%M}.grib2').metpy.parse_cf()
-                self.recent = True
-            elif (self.time >= datetime(2004, 3, 2)):
-                try:
-                    self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files/'f'{self.time:%Y%m/%Y%m%d}/gfs_3_{self.time:%Y%m%d_%H}00_{delta:03d}.grb2').metpy.parse_cf()
-                except:
-                    try:
-                        self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-g3-anl-files-old/'f'{self.time:%Y%m/%Y%m%d}/gfsanl_3_{self.time:%Y%m%d_%H}00_000.grb2').metpy.parse_cf()
-                    except:
-                        try:
-                            self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-003-files-old/'f'{self.time:%Y%m/%Y%m%d}/gfs_3_{self.time:%Y%m%d_%H}00_{delta:03d}.grb2').metpy.parse_cf()
-                        except:
-                            print("(AMGP_GRDF) <warning> Gridded data could not be found for the date you have selected!")
-                            self.grd = None
-            elif (self.time >= datetime(1979, 1, 1)):
-                self.grd = xr.open_dataset('https://www.ncei.noaa.gov/thredds/dodsC/model-narr-a-files/'f'{self.time:%Y%m/%Y%m%d}/narr-a_221_{self.time:%Y%m%d_%H}00_000.grb').metpy.parse_cf().metpy.assign_latitude_longitude()
-            else:
-                print("(AMGP_GRDF) <warning> The date you have selected has no gridded data available!")
-                self.grd = None
-        try:
-            if level == 'surface':
-                tmpk = self.grd.Temperature_height_above_ground.metpy.sel(vertical=2*units.m, time=self.time + timedelta(hours=delta))
-                uwind = self.grd['u-component_of_wind_height_above_ground'].metpy.sel(vertical=10*units.m, time=self.time + timedelta(hours=delta))
-                vwind = self.grd['v-component_of_wind_height_above_ground'].metpy.sel(vertical=10*units.m, time=self.time + timedelta(hours=delta))
-                self.grd['wind_speed_height_above_ground'] = mpcalc.wind_speed(uwind, vwind)
-            else:
-                tmpk = self.grd.Temperature_isobaric.metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                uwind = self.grd['u-component_of_wind_isobaric'].metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                vwind = self.grd['v-component_of_wind_isobaric'].metpy.sel(vertical=level*units.hPa, time=self.time + timedelta(hours=delta))
-                self.grd['wind_speed_isobaric'] = mpcalc.wind_speed(uwind, vwind)
-            self.grd['relative_vorticity'] = mpcalc.vorticity(uwind, vwind)
-            self.grd['temperature_advection'] = mpcalc.advection(tmpk, uwind, vwind)
-            hght_500 = self.grd.Geopotential_height_isobaric.metpy.sel(time=self.time + timedelta(hours=delta), vertical=500 * units.hPa).metpy.quantify()
-            hght_1000 = self.grd.Geopotential_height_isobaric.metpy.sel(time=self.time + timedelta(hours=delta), vertical=1000 * units.hPa).metpy.quantify()
-            self.grd['thickness_500_1000'] = (hght_500 - hght_1000).metpy.dequantify()
-        except:
-            print("(AMGP_GRDF) <warning> Derived variables could not be calculated using the current dataset(s)")
-
-        try:
-            self.grd["Geopotential_height_isobaric"] = self.grd["hgt"]
-            self.Converted = "hgt"
-        except:
-            self.Converted = None
-        
+def FetchData(Time, level, delta, LocalData, extent=None, needs=[], levels=None):
+    return amgpgrd.FetchData(Time, level, delta, LocalData, "1000", extent, needs, levels)
 
-def FetchData(Time, level, delta, LocalData):
-    return Data(Time, level, delta, LocalData)
\ No newline at end of file
+def Prefetch(Time, factors, values, deltas, LocalData=None):
+    level = amgp.GetLevel(values['level']).level
+    amgpgrd.FetchRun(Time, level, deltas, LocalData, "1000", values.get('extent'), amgpgrd.Needs(factors, level))
@@ -11,7 +11,7 @@
 ################################################
 
 from datetime import datetime, timedelta
-from io import StringIO
+from io import StringIO, BytesIO
 from urllib.request import urlopen
 from siphon.simplewebservice.iastate import IAStateUpperAir
 from siphon.catalog import TDSCatalog
@@ -23,6 +23,7 @@ from metpy.io import metar
 from metpy.plots import declarative, PlotGeometry
 from metpy.units import units
 import metpy.calc as mpcalc
+from scipy.spatial import cKDTree
 import xarray as xr
 import pandas as pd
 import geopandas as gpd
@@ -35,6 +36,8 @@ from PIL import Image as PImage
 from PIL import ImageDraw, ImageFont, ImageFilter
 import json
 import glob
+import hashlib
+import threading
 import contextlib
 from importlib import import_module
 
@@ -72,39 +75,11 @@ def Panel(Time, plotslist, values, area_dictionary, amgpmodules, titleOverride,
     level = values['level']
     
     # Parse custom zoom feature
-    simArea = values['area'].replace("+", "")
-    simArea = simArea.replace("-", "")
-    if simArea in area_dictionary:
-        splitArea = Counter(values['area'])
-        factor = (splitArea['+']) - (splitArea['-'])
-        scaleFactor = (1 - 2**-factor)/2
-        west, east, south, north = area_dictionary[f'{simArea}']
-        newWest = west - (west - east) * scaleFactor
-        newEast = east + (west - east) * scaleFactor
-        newSouth = south - (south - north) * scaleFactor
-        newNorth = north + (south - north) * scaleFactor
-        modArea = newWest, newEast, newSouth, newNorth
-    
+    modArea = amgp.ParseArea(values['area'], area_dictionary)
+    try:
         panel.area = modArea
-    else:
-        try:
-            panel.area = f'{values["area"]}'
-        except:
-            print("(AMGP_MAP) <error> The panel area you have put in does not exist!")
-            amgpplt.inputChain()
-
-    # Figuring out the data display area
-    areaZero = list(panel.area)
-    areaScaleA = 1.1
-    areaScaleB = 0.9
-    if areaZero[0] < 0:
-        areaZero[0] = 360 + (areaZero[0] * areaScaleA)
-    if areaZero[1] < 0:
-        areaZero[1] = 360 + (areaZero[1] * areaScaleB)
-    areaZero[2] = areaZero[2] * areaScaleB
-    areaZero[3] = areaZero[3] * areaScaleA
-    latSlice = slice(areaZero[3], areaZero[2])
-    lonSlice = slice(areaZero[0], areaZero[1])
+    except:
+        amgpplt.Abort("AMGP_MAP", "The panel area you have put in does not exist!", values)
     
     panel.layers = ['states', 'coastline', 'borders']
     
@@ -128,8 +103,13 @@ def Panel(Time, plotslist, values, area_dictionary, amgpmodules, titleOverride,
         projection = values['projection']
     panel.projection = projection
     
-    # Data acquisition and packaging
+    # Data acquisition and packaging; plots already drawn on another panel, as in multi-area runs, are drawn afresh
+    for plot in plotslist:
+        if getattr(plot, 'handle', None) is not None:
+            plot.handle = None
+            plot._need_redraw = True
     panel.plots = plotslist
+    ReducePoints(panel, values)
     
     plotTypes = amgpplt.PullFactors(values, amgpmodules)[0]
     fillTypes = amgpplt.PullFactors(values, amgpmodules)[1]
@@ -210,7 +190,279 @@ def Panel(Time, plotslist, values, area_dictionary, amgpmodules, titleOverride,
                             
     return {'panelSize':(scaledDiff, scaledDiff),'panel':panel,'timeObj':Time,'values':values, 'titlebits':titlebits,'filltype':fillTypes,'ver':version, 'valid':True}
     
-def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False):
+# Thins station plots here, where the projection is known, instead of in PlotObs. The stations kept are remembered per
+# area, projection and prfactor, so that the next map of a loop reuses them and only reconsiders stations that appeared
+# or disappeared, which also keeps the station layout steady from frame to frame.
+def ReducePoints(panel, values):
+    if panel.projection is None:
+        return
+    for plot in panel.plots:
+        if not isinstance(plot, declarative.PlotObs):
+            continue
+        # A plot already drawn on another area's panel is thinned again from the stations it started with
+        if hasattr(plot, 'unthinned'):
+            plot.data, plot.reduce_points = plot.unthinned
+        if not plot.reduce_points:
+            continue
+        try:
+            proj = panel._proj_obj
+            key = (values['area'], proj.proj4_init, float(plot.reduce_points))
+            unthinned = (plot.data, plot.reduce_points)
+            # The same scale PlotObs uses, so that prfactor means what it always has
+            scale = 1. if isinstance(proj, ccrs.PlateCarree) else 100000.
+            plot.data = Thin(plot.obsdata, proj, float(plot.reduce_points) * scale, key)
+            plot.reduce_points = 0
+            plot.unthinned = unthinned
+        except:
+            continue
+
+def Thin(data, proj, radius, key):
+    column = 'station_id' if 'station_id' in data.columns else 'station'
+    stations = data[column].values
+    if len(set(stations)) != len(stations):
+        raise ValueError("Stations must be unique to be thinned by name")
+    locs = proj.transform_points(ccrs.PlateCarree(), data['longitude'].values, data['latitude'].values)[:, :2]
+    digest = hashlib.md5('\n'.join(map(str, stations)).encode()).hexdigest()
+    
+    cache = amgp.GetCache("stations", lambda state: 128 * len(state['locs']))
+    with cache.Locked(key):
+        state = cache.Get(key)
+        if state is None:
+            keep = mpcalc.reduce_point_density(locs, radius)
+        elif state['hash'] == digest:
+            keep = np.isin(stations, list(state['kept']))
+        else:
+            keep = Rethin(state, stations, locs, radius)
+        cache.Put(key, {'hash': digest, 'kept': set(stations[keep]), 'locs': dict(zip(stations, map(tuple, locs)))})
+    return data[keep]
+
+# Updates the last map's thinning: the stations it kept stay if they are still reported, and the stations that are new,
+# or that lost the kept neighbour which hid them, are added in order wherever no kept station is within the radius.
+def Rethin(state, stations, locs, radius):
+    old = state['locs']
+    keep = np.zeros(len(stations), dtype=bool)
+    seen = set()
+    for i, station in enumerate(stations):
+        if (station in old) and np.allclose(old[station], locs[i]):
+            seen.add(station)
+            keep[i] = station in state['kept']
+    removed = [loc for station, loc in old.items() if (station in state['kept']) and (station not in seen)]
+    removedTree = cKDTree(removed) if len(removed) > 0 else None
+    
+    candidates = [i for i, station in enumerate(stations) if (station not in seen) or ((not keep[i]) and (removedTree is not None) and (len(removedTree.query_ball_point(locs[i], radius)) > 0))]
+    keptTree = cKDTree(locs[keep]) if keep.any() else None
+    added = []
+    for i in candidates:
+        if (keptTree is not None) and (len(keptTree.query_ball_point(locs[i], radius)) > 0):
+            continue
+        if (len(added) > 0) and (np.hypot(*(np.array(added) - locs[i]).T).min() <= radius):
+            continue
+        keep[i] = True
+        added.append(locs[i])
+    return keep
+
+# Renders a panel container to a watermarked image in memory. The image is taken straight from the canvas's pixels,
+# so the only encode is the map's own save, and renders never share a temporary file.
+# pyplot keeps one global figure manager and the reused figures are shared, so concurrent runs draw one at a time;
+# retrieval and everything before drawing still go on side by side
+renderLock = threading.RLock()
+
+def Render(pc, dpi, version, fill, reuse=False):
+    with renderLock:
+        image = Draw(pc, dpi, reuse)
+    return amgp.Watermark(image, version, fill)
+
+def Draw(pc, dpi, reuse):
+    if reuse:
+        try:
+            pc = Reuse(pc, dpi)
+        except:
+            reuse = False
+    
+    # The layers are drawn without their shapefiles, so that the basemap is cut to the axes as colorbars have left
+    # them; the panel gets its layers back once it is drawn
+    underlays = []
+    if not reuse:
+        for panel in pc.panels:
+            underlays.append((panel, panel.layers))
+            panel.layers = []
+    try:
+        pc.draw()
+        for panel, layers in underlays:
+            try:
+                Underlay(panel, Basemap(panel, layers, pc.size, dpi))
+            except:
+                for feature in Features(layers):
+                    panel.ax.add_feature(feature)
+        
+        image = Pixels(pc.figure, dpi)
+    finally:
+        for panel, layers in underlays:
+            panel.layers = layers
+        if not reuse:
+            plt.close(pc.figure)
+    return image
+
+# The figure drawn at dpi, cut to the box savefig's bbox_inches='tight' would save. A figure whose tight box reaches
+# past its edges, which savefig would grow to fit, or a canvas without an RGBA buffer goes through an uncompressed PNG.
+def Pixels(figure, dpi):
+    try:
+        figure.set_dpi(dpi)
+        figure.canvas.draw()
+        box = figure.get_tightbbox(figure.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+        width, height = figure.canvas.get_width_height()
+        left, right = int(np.floor(box.x0 * dpi)), int(np.ceil(box.x1 * dpi))
+        top, bottom = height - int(np.ceil(box.y1 * dpi)), height - int(np.floor(box.y0 * dpi))
+        if (left >= 0) and (top >= 0) and (right <= width) and (bottom <= height):
+            return PImage.frombuffer('RGBA', (width, height), figure.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).crop((left, top, right, bottom))
+    except:
+        pass
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight', pil_kwargs={'compress_level': 0})
+    buffer.seek(0)
+    return PImage.open(buffer).convert('RGBA')
+
+# The cartopy features of a panel's layers, as MapPanel draws them
+def Features(layers):
+    panel = declarative.MapPanel()
+    panel.layers = layers
+    return list(panel._layer_features)
+
+def Underlay(panel, image):
+    extent = panel.ax.get_extent()
+    panel.ax.imshow(image, extent=extent, transform=panel.ax.projection, origin='upper', interpolation='antialiased', zorder=1.5)
+    panel.ax.set_extent(extent, crs=panel.ax.projection)
+
+# Figures kept between the frames of a loop, by framing. Each keeps its axes, projection and basemap, and a frame only
+# swaps in its own plots and titles after the last frame's data artists and colorbars are taken off.
+reused = {}
+
+def Reuse(pc, dpi):
+    panel = pc.panels[0]
+    area = tuple(panel.area) if type(panel.area) != str else panel.area
+    key = (area, panel._proj_obj.proj4_init, tuple(pc.size), dpi, tuple(panel.layers))
+    
+    if key not in reused:
+        if len(reused) >= 8:
+            for state in reused.values():
+                plt.close(state['pc'].figure)
+            reused.clear()
+        kept = declarative.MapPanel()
+        kept.layout = panel.layout
+        kept.area = panel.area
+        kept.projection = panel.projection
+        kept.layers = []
+        keptpc = declarative.PanelContainer()
+        keptpc.size = pc.size
+        keptpc.panels = [kept]
+        keptpc.draw()
+        try:
+            Underlay(kept, Basemap(kept, panel.layers, pc.size, dpi))
+        except:
+            for feature in Features(panel.layers):
+                kept.ax.add_feature(feature)
+        reused[key] = {'pc': keptpc, 'baseline': set(kept.ax.get_children()), 'axes': list(keptpc.figure.axes), 'position': kept.ax.get_position()}
+    
+    state = reused[key]
+    kept = state['pc'].panels[0]
+    for artist in kept.ax.get_children():
+        if artist not in state['baseline']:
+            with contextlib.suppress(Exception):
+                artist.remove()
+    for axes in state['pc'].figure.axes:
+        if axes not in state['axes']:
+            axes.remove()
+    kept.ax.set_position(state['position'])
+    
+    kept.plots = panel.plots
+    kept.title = panel.title
+    kept.left_title = panel.left_title
+    kept.right_title = panel.right_title
+    kept.title_fontsize = panel.title_fontsize
+    return state['pc']
+
+# The static layers (states, coastlines, borders) of a drawn panel, rendered once per area, projection, figure size,
+# dpi and final axes size into a clear image that every later map with the same framing lays over its data instead of
+# reprojecting the shapefiles. The axes' size is taken after the panel is drawn, since colorbars shrink it.
+def Basemap(panel, layers, size, dpi):
+    area = tuple(panel.area) if type(panel.area) != str else panel.area
+    position = panel.ax.get_position()
+    pixels = (int(round(position.width * size[0] * dpi)), int(round(position.height * size[1] * dpi)))
+    key = (area, panel._proj_obj.proj4_init, tuple(size), dpi, tuple(layers), pixels)
+    cache = amgp.GetCache("basemaps", lambda image: image.nbytes)
+    return cache.Fetch(key, lambda: DrawBasemap(panel, layers, size, dpi, position))
+
+def DrawBasemap(panel, layers, size, dpi, position):
+    base = declarative.MapPanel()
+    base.layout = panel.layout
+    base.area = panel.area
+    base.projection = panel.projection
+    base.layers = layers
+    pc = declarative.PanelContainer()
+    pc.size = size
+    pc.panels = [base]
+    pc.draw()
+    base.ax.set_position(position)
+    
+    # Only the lines are kept, over a clear background, so that images like satellite channels show through
+    pc.figure.patch.set_alpha(0)
+    base.ax.patch.set_alpha(0)
+    with contextlib.suppress(Exception):
+        base.ax.background_patch.set_alpha(0)
+    pc.figure.set_dpi(dpi)
+    pc.figure.canvas.draw()
+    
+    # Only the map axes is kept, cut from the figure at the dpi the map is saved at
+    box = base.ax.get_window_extent()
+    image = np.asarray(pc.figure.canvas.buffer_rgba())
+    top = image.shape[0] - int(round(box.y1))
+    bottom = image.shape[0] - int(round(box.y0))
+    image = image[top:bottom, int(round(box.x0)):int(round(box.x1))].copy()
+    plt.close(pc.figure)
+    return image
+
+# The finished, watermarked map of a product as an image, without saving or showing it; None for a cancelled product
+def Image(product, reuse=False):
+    if product['valid'] != True:
+        return None
+    fill = 0
+    if 1 in product['filltype']:
+        fill = 1
+    pc = declarative.PanelContainer()
+    pc.size = product['panelSize']
+    pc.panels = [product['panel']]
+    return Render(pc, int(product['values']['dpi']), product['ver'], fill, reuse)
+
+# What a product shows, and the file name SaveMap would give it
+def Describe(product):
+    Time = product['timeObj']
+    if type(product['titlebits']) == list:
+        inst = ', '.join(product['titlebits'])
+    else:
+        inst = str(product['titlebits'])
+    nowstamp = amgp.ParseTime("recent", [-1], Time.now, "raw", "latest").tsfull
+    return {'time':Time.tsfull,
+            'category':Time.category,
+            'area':product['values']['area'],
+            'level':product['values']['level'],
+            'delta':product['values']['delta'],
+            'factors':product['values']['factors'],
+            'title':product['panel'].title,
+            'dpi':int(product['values']['dpi']),
+            'ver':product['ver'],
+            'name':f"{Time.tsnum}; {product['values']['area']}; {inst} - {Time.category}; {nowstamp}.png"}
+
+# The maps saved by the current thread, for callers like the daemon that report where a job's maps went; a thread
+# only records them once it has set saved.paths to a list
+saved = threading.local()
+
+def Saved(path):
+    paths = getattr(saved, 'paths', None)
+    if paths is not None:
+        paths.append(path)
+
+# reuse keeps the figure between maps of the same framing, for loops where only the data changes
+def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False, reuse=False):
 
     if doSave == "FALSE":
         doSave = False
@@ -267,21 +519,16 @@ def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False):
                     os.mkdir(f'{dr}/{yearstamp}/{monthstamp}')
                 if OldDirD == False:
                     os.mkdir(f'{dr}/{yearstamp}/{monthstamp}/{daystamp}')
-                pc.save(f"{dr}/Temp/Temp.png", dpi=int(product['values']['dpi']), bbox_inches='tight')
-                save = PImage.open(f"{dr}/Temp/Temp.png").convert('RGBA')
-                save = amgp.Watermark(save, version, fill)
-                save.save(f"{dr}/{yearstamp}/{monthstamp}/{daystamp}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png")
+                save = Render(pc, int(product['values']['dpi']), version, fill, reuse)
+                path = f"{dr}/{yearstamp}/{monthstamp}/{daystamp}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png"
+                save.save(path)
+                Saved(path)
                 if noShow == False:
                     save.show()
                 print("(AMGP_MAP) <run> Map successfully saved!")
             else:
-                if os.path.isdir(f"{dr}/Temp") == False:
-                    os.mkdir(f"{dr}/Temp")
-                pc.save(f"{dr}/Temp/Temp.png", dpi=int(product['values']['dpi']), bbox_inches='tight')
-                save = PImage.open(f'{dr}/Temp/Temp.png').convert('RGBA')
-                save = amgp.Watermark(save, version, fill)
+                save = Render(pc, int(product['values']['dpi']), version, fill, reuse)
                 save.show()
-            amgp.ClearTemp()
         elif (altDir==False):
             dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Maps")
             OldDir = os.path.isdir(f'{dr}/Projects/{proj}')
@@ -293,11 +540,10 @@ def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False):
     
             if OldDir == False:
                 os.mkdir(f'{dr}/Projects/{proj}')
-            pc.save(f"{dr}/Temp/Temp.png", dpi=int(product['values']['dpi']), bbox_inches='tight')
-            save = PImage.open(f"{dr}/Temp/Temp.png").convert('RGBA')
-            save = amgp.Watermark(save, version, fill)
-            save.save(f"{dr}/Projects/{proj}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png")
-            amgp.ClearTemp()
+            save = Render(pc, int(product['values']['dpi']), version, fill, reuse)
+            path = f"{dr}/Projects/{proj}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png"
+            save.save(path)
+            Saved(path)
         else:
             if altDirCon:
                 if type(product['titlebits']) == str:
@@ -305,9 +551,7 @@ def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False):
                 elif type(product['titlebits']) == list:
                     inst = ', '.join(product['titlebits'])
                 dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Maps")
-                pc.save(f"{dr}/Temp/Temp.png", dpi=int(product['values']['dpi']), bbox_inches='tight')
-                save = PImage.open(f"{dr}/Temp/Temp.png").convert('RGBA')
-                save = amgp.Watermark(save, version, fill)
+                save = Render(pc, int(product['values']['dpi']), version, fill, reuse)
     
                 OldDirY = os.path.isdir(f'{proj}/{yearstamp}')
                 OldDirM = os.path.isdir(f'{proj}/{yearstamp}/{monthstamp}')
@@ -320,19 +564,19 @@ def SaveMap(product, doSave, noShow, proj='', altDir=False, altDirCon=False):
                 if OldDirD == False:
                     os.mkdir(f'{proj}/{yearstamp}/{monthstamp}/{daystamp}')
                 
-                save.save(f"{proj}/{yearstamp}/{monthstamp}/{daystamp}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png")
-                amgp.ClearTemp()
+                path = f"{proj}/{yearstamp}/{monthstamp}/{daystamp}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png"
+                save.save(path)
+                Saved(path)
             else:
                 if type(product['titlebits']) == str:
                     inst = product['titlebits']
                 elif type(product['titlebits']) == list:
                     inst = ', '.join(product['titlebits'])
                 dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Maps")
-                pc.save(f"{dr}/Temp/Temp.png", dpi=int(product['values']['dpi']), bbox_inches='tight')
-                save = PImage.open(f"{dr}/Temp/Temp.png").convert('RGBA')
-                save = amgp.Watermark(save, version, fill)
-                save.save(f"{proj}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png")
-                amgp.ClearTemp()
+                save = Render(pc, int(product['values']['dpi']), version, fill, reuse)
+                path = f"{proj}/{timestampNum}; {product['values']['area']}; {inst} - {cat}; {nowstamp}.png"
+                save.save(path)
+                Saved(path)
         
     else:
         amgp.ThrowError("AMGP_MAP", 2, f"Map for {product['timeObj'].ds} cancelled.", True, False, False)
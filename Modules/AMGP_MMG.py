@@ -37,6 +37,8 @@ import json
 import glob
 import contextlib
 from importlib import import_module
+import multiprocessing
+import threading
 import time
 
 from tkinter import *
@@ -142,9 +144,9 @@ def multiMode():
             print("(AMGP_MMG) <error> That is not a valid command!")
             multiMode()
     elif command[0] == 'edit':
-        if command[1] in ["Level", "Date", "Delta", "Factors", "Area", "DPI", "Scale", "PRF", "BF", "Smooth", "Projection", "TM", "CM", "LDS", "EndDate", "DeltaLoop", "TimeStep"]:
+        if command[1] in ["Level", "Date", "Delta", "Factors", "Area", "DPI", "Scale", "PRF", "BF", "Smooth", "Projection", "TM", "CM", "LDS", "EndDate", "DeltaLoop", "TimeStep", "DeltaMax", "Workers", "Reuse"]:
             if command[1] == "Level":
-                loadedObs.update({'level':command[2]})
+                loadedObs.update({'level':", ".join(item.strip(",") for item in command[2:])})
             if command[1] == "Date":
                 if command[2] == 'recent':
                     loadedObs.update({'date':command[2]})
@@ -184,7 +186,7 @@ def multiMode():
                 fullFactors = ', '.join(blankFactors)
                 loadedObs.update({'factors':fullFactors})
             if command[1] == "Area":
-                loadedObs.update({'area':command[2]})
+                loadedObs.update({'area':", ".join(item.strip(",") for item in command[2:])})
             if command[1] == "DPI":
                 loadedObs.update({'dpi':command[2]})
             if command[1] == "Scale":
@@ -235,6 +237,16 @@ def multiMode():
                     loadedMMG.update({'ts':f'{command[2]}, {command[3]}, {command[4]}, {command[5]}'})
             if command[1] == "DeltaMax":
                 loadedMMG.update({'dm':command[2]})
+            if command[1] == "Workers":
+                if (not command[2].isdigit()) or (int(command[2]) < 1):
+                    print("(AMGP_MMG) <error> That is not a valid value for Workers!")
+                    multiMode()
+                loadedMMG.update({'workers':command[2]})
+            if command[1] == "Reuse":
+                if command[2] not in ["y","n"]:
+                    print("(AMGP_MMG) <error> That is not a valid value for Reuse!")
+                    multiMode()
+                loadedMMG.update({'reuse':command[2]})
             loadings()
             multiMode()
         else:
@@ -330,6 +342,8 @@ def loadings():
     print(f"(AMGP_MMG) <loaded> DeltaLoop: {loadedMMG['dl']}")
     print(f"(AMGP_MMG) <loaded> TimeStep: {loadedMMG['ts']}")
     print(f"(AMGP_MMG) <loaded> DeltaMax: {loadedMMG['dm']}")
+    print(f"(AMGP_MMG) <loaded> Workers: {loadedMMG.get('workers', '1')}")
+    print(f"(AMGP_MMG) <loaded> Reuse: {loadedMMG.get('reuse', 'n')}")
     
 def saveSet(cat, name):
     dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Presets")
@@ -346,7 +360,7 @@ def saveSet(cat, name):
         print(f"(AMGP_MMG) <save> Loaded obs settings saved to Presets/plot as preset: {name}.json")
     
     if cat == "mmg":
-        saveState = {"end":f"{loadedMMG['end']}","dl":f"{loadedMMG['dl']}","ts":f"{loadedMMG['ts']}","dm":f"{loadedMMG['dm']}"}
+        saveState = {"end":f"{loadedMMG['end']}","dl":f"{loadedMMG['dl']}","ts":f"{loadedMMG['ts']}","dm":f"{loadedMMG['dm']}","workers":f"{loadedMMG.get('workers', '1')}","reuse":f"{loadedMMG.get('reuse', 'n')}"}
         data = {"amgp_ver":unpack['ver'],"type":"mmg","settings":saveState}
 
         if os.path.isfile(f"{dr}/mmg/{name}.json"):
@@ -362,31 +376,86 @@ def stepCounter(ts):
     return timedelta(days=int(splits[0]),hours=int(splits[1]),minutes=int(splits[2]))
     
 
+# One frame of a loop: every level and area of one base date and forecast hour
+def Frame(job):
+    obs, extras = job
+    made = False
+    for levelObs in amgpplt.Levels(obs):
+        Time, plotslist, values = amgpplt.run(levelObs, {"amgpmodules": unpack['datamods'], "S": True, "noShow": True, "proj": extras['proj'], "direct": False, "title": extras['title'], "altDir": extras['altDir'], "altDirCon": extras['altDirCon'], "now": extras['now'], "areas": unpack['customareas'], "version": unpack['ver']})
+        for areaValues in amgpplt.Areas(values, unpack['customareas']):
+            if extras['title'] == "y":
+                amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, areaValues, unpack['customareas'], unpack['datamods'], f'{obs["date"]} - {obs["delta"]} hour forecast', unpack['ver']), True, True, extras['proj'], extras['altDir'], extras['altDirCon'], extras['reuse'])
+            else:
+                amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, areaValues, unpack['customareas'], unpack['datamods'], '', unpack['ver']), True, True, extras['proj'], extras['altDir'], extras['altDirCon'], extras['reuse'])
+        made = made or ("cancel" not in plotslist)
+    return made
+
+def WorkerInit():
+    plt.switch_backend('Agg')
+
+# Frames run in worker processes report failures back instead of stopping the loop
+def PoolFrame(job):
+    try:
+        return Frame(job), None
+    except:
+        return False, f"{sys.exc_info()[0].__name__}: {sys.exc_info()[1]}"
+
 def run(totdat, extras):
     obs = totdat["OBS"]
     mmg = totdat["MMG"]
-    proj = extras["proj"]
-    title = extras["title"]
-    altDir = extras["altDir"]
-    altDirCon = extras["altDirCon"]
-
+    
+    # Every frame shares one 'now', so that file names depend only on the frame and not on when it finished
+    frameExtras = {"proj": extras["proj"], "title": extras["title"], "altDir": extras["altDir"], "altDirCon": extras["altDirCon"], "now": amgp.setTime(), "reuse": mmg.get('reuse', 'n') == 'y'}
+    deltas = list(range(0, int(mmg['dm']) + 1, max(int(mmg['dl']), 1)))
+    
     startDate = amgp.ParseTime(obs['date']).time
     endDate = amgp.ParseTime(mmg['end']).time
+    jobs = []
     while startDate <= endDate:
-        obs['date'] = f"{startDate.year}, {startDate.month}, {startDate.day}, {startDate.hour}, {startDate.minute}"
-        delta = 0
-        while delta <= int(mmg['dm']):
-            modObs = obs
-            modObs['delta'] = delta
-            Time, plotslist, values = amgpplt.run(modObs, {"amgpmodules": unpack['datamods'], "S": True, "noShow": True, "proj": proj, "direct": False, "title": title, "altDir": altDir, "altDirCon": altDirCon})
-            if title == "y":
-                amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, values, unpack['customareas'], unpack['datamods'], f'{modObs["date"]} - {delta} hour forecast', unpack['ver']), True, True, proj, altDir, altDirCon)
-            else:
-                amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, values, unpack['customareas'], unpack['datamods'], '', unpack['ver']), True, True, proj, altDir, altDirCon)
-            if "cancel" not in plotslist:
-                print(f"(AMGP_MMG) <run> Made a map for {startDate.year}, {startDate.month}, {startDate.day}, {startDate.hour}, {startDate.minute} + {delta}")
-            if int(mmg['dl']) != 0:
-                delta = delta + int(mmg['dl'])
-            else:
-                delta = delta + 1
-        startDate = startDate + stepCounter(mmg['ts'])
\ No newline at end of file
+        for delta in deltas:
+            frameObs = dict(obs)
+            frameObs['date'] = f"{startDate.year}, {startDate.month}, {startDate.day}, {startDate.hour}, {startDate.minute}"
+            frameObs['delta'] = delta
+            jobs.append((frameObs, frameExtras))
+        if stepCounter(mmg['ts']) == timedelta(0):
+            break
+        startDate = startDate + stepCounter(mmg['ts'])
+    
+    if len(jobs) == 0:
+        return
+    
+    plans = amgpplt.PrefetchRange(obs, {"amgpmodules": unpack['datamods'], "areas": unpack['customareas'], "now": frameExtras['now']}, list(dict.fromkeys(job[0]['date'] for job in jobs)))
+    for frameObs, frameExtras in jobs:
+        frameObs['plans'] = plans
+    
+    try:
+        workers = int(mmg.get('workers', 1))
+    except:
+        workers = 0
+    if workers < 1:
+        print(f"(AMGP_MMG) <warning> Workers must be a whole number of at least 1, not '{mmg.get('workers')}'; running with one worker")
+        workers = 1
+    if (workers > 1) and ('fork' not in multiprocessing.get_all_start_methods()):
+        print("(AMGP_MMG) <warning> Parallel loops need processes that can be forked from this one; running with one worker")
+        workers = 1
+    # Forking while other threads hold locks (as under --serve) can leave the children stuck on them
+    if (workers > 1) and (threading.current_thread() is not threading.main_thread()):
+        print("(AMGP_MMG) <warning> Parallel loops only run from the main thread; running with one worker")
+        workers = 1
+    
+    if workers > 1:
+        with multiprocessing.get_context('fork').Pool(workers, initializer=WorkerInit) as pool:
+            for (frameObs, frameExtras), (made, error) in zip(jobs, pool.imap(PoolFrame, jobs)):
+                if error is not None:
+                    print(f"(AMGP_MMG) <warning> The map for {frameObs['date']} + {frameObs['delta']} failed: {error}")
+                elif made:
+                    print(f"(AMGP_MMG) <run> Made a map for {frameObs['date']} + {frameObs['delta']}")
+    else:
+        prefetched = None
+        for job in jobs:
+            frameObs = job[0]
+            if frameObs['date'] != prefetched:
+                amgpplt.Prefetch(frameObs, {"amgpmodules": unpack['datamods'], "areas": unpack['customareas'], "now": frameExtras['now']}, deltas)
+                prefetched = frameObs['date']
+            if Frame(job):
+                print(f"(AMGP_MMG) <run> Made a map for {frameObs['date']} + {frameObs['delta']}")
@@ -85,7 +85,7 @@ def Retrieve(Time, factors, values, LocalData=None):
     level = LVL.level
     
     # Pulling the surface data
-    Data = FetchData(Time, level, LocalData)
+    Data = FetchData(Time, level, LocalData, values.get('plans', {}).get("AMGP_OBS"))
     
     # Level-based formatting
     
@@ -106,8 +106,11 @@ def Retrieve(Time, factors, values, LocalData=None):
         obs.data = Data.uaDat
     
     if obs.data is None:
-        print("(AMGP_OBS) <error> You cannot make a map using factors that would cause obs data to attempt and fail a pull.")
-        amgpplt.inputChain()
+        amgpplt.Abort("AMGP_OBS", "You cannot make a map using factors that would cause obs data to attempt and fail a pull.", values)
+    
+    # Only stations on or near the map are projected and thinned
+    if type(values.get('extent')) == tuple:
+        obs.data = obs.data[amgp.InArea(obs.data['latitude'], obs.data['longitude'], values['extent'])]
     
     try:
         obs.time = Time.time
@@ -182,7 +185,7 @@ def Retrieve(Time, factors, values, LocalData=None):
     return partialPlotsList
 
 class Data(object):
-    def __init__(self, Time, level, LocalData):
+    def __init__(self, Time, level, LocalData, chunks=None):
         
         if (Time.category == 'sync') or (Time.category == 'raw') or (Time.category == 'near'):
             timesfc = Time.time
@@ -197,33 +200,7 @@ class Data(object):
                     self.sfcDat = xr.open_dataset(Dataset[0])
         else:
             if level == 'surface':
-                if timesfc.year < 2019:
-                    try:
-                        self.sfcDat = pd.read_csv(f'http://bergeron.valpo.edu/archive_surface_data/{timesfc:%Y}/{timesfc:%Y%m%d}_metar.csv', parse_dates=['date_time'], na_values=[-9999], low_memory=False)
-                        self.weather_format = 'present_weather'
-                        self.sfcDat['tmpf'] = (self.sfcDat.air_temperature.values * units.degC).to('degF')
-                        self.sfcDat['dwpf'] = (self.sfcDat.dew_point_temperature.values * units.degC).to('degF')
-                    except:
-                        print("(AMGP_OBS) <warning> Archive surface obs not found!")
-                        self.sfcDat = None
-                else:
-                    try:
-                        data = StringIO(urlopen('http://bergeron.valpo.edu/current_surface_data/'f'{timesfc:%Y%m%d%H}_sao.wmo').read().decode('utf-8', 'backslashreplace'))
-                        self.sfcDat = metar.parse_metar_file(data, year=timesfc.year, month=timesfc.month)
-                        self.sfcDat['tmpf'] = (self.sfcDat.air_temperature.values * units.degC).to('degF')
-                        self.sfcDat['dwpf'] = (self.sfcDat.dew_point_temperature.values * units.degC).to('degF')
-                        self.weather_format = 'current_wx1_symbol'
-                    except:
-                        try:
-                            data = pd.read_csv(f'http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?data=all&tz=Etc/UTC&format=comma&latlon=yes&year1={timesfc.year}&month1={timesfc.month}&day1={timesfc.day}&hour1={timesfc.hour}&minute1={timesfc.minute}&year2={timesfc.year}&month2={timesfc.month}&day2={timesfc.day}&hour2={timesfc.hour}&minute2={timesfc.minute}', skiprows=5, na_values=['M'], low_memory=False).replace('T', 0.00001).groupby('station').tail(1)
-                            self.sfcDat = metar.parse_metar_file(StringIO('\n'.join(val for val in data.metar)), year=timesfc.year, month=timesfc.month)
-                            self.sfcDat['date_time'] = timesfc
-                            self.weather_format = 'current_wx1_symbol'
-                            self.sfcDat['tmpf'] = (self.sfcDat.air_temperature.values * units.degC).to('degF')
-                            self.sfcDat['dwpf'] = (self.sfcDat.dew_point_temperature.values * units.degC).to('degF')
-                        except:
-                            print("(AMGP_OBS) <warning> Recent surface obs not found!")
-                            self.sfcDat = None
+                self.sfcDat, self.weather_format = Surface(timesfc, chunks)
     #            else:
     #                print("<warning> The date you have selected is not in range for surace obs!")
     #                self.sfcDat = None
@@ -231,13 +208,149 @@ class Data(object):
             
             if level != 'surface':
                 try:
-                    self.uaDat = IAStateUpperAir.request_all_data(timeua)
-                    self.uaDat = add_station_lat_lon(self.uaDat, 'station').dropna(subset=['latitude', 'longitude'])
-                    self.uaDat = self.uaDat[self.uaDat.station != 'KVER'] # "central Missouri" station that shouldn't be there, due to faulty lat-lon data
-                    self.uaDat['dewpoint_depression'] = self.uaDat['temperature'] - self.uaDat['dewpoint']
+                    cache = amgp.GetCache("soundings", lambda uaDat: int(uaDat.memory_usage(deep=True).sum()))
+                    self.uaDat = cache.Fetch((f"{timeua:%Y%m%d%H}", amgp.Freshness(timeua, 6)), lambda: Soundings(timeua))
                 except:
                     print("(AMGP_OBS) <warning> The date you have selected has no upper-air data available!")
                     self.uaDat = None
 
-def FetchData(Time, level, LocalData):
-    return Data(Time, level, LocalData)
\ No newline at end of file
+def FetchData(Time, level, LocalData, chunks=None):
+    return Data(Time, level, LocalData, chunks)
+
+def ValpoArchive(timesfc):
+    return pd.read_csv(f'http://bergeron.valpo.edu/archive_surface_data/{timesfc:%Y}/{timesfc:%Y%m%d}_metar.csv', parse_dates=['date_time'], na_values=[-9999], low_memory=False)
+
+def ValpoCurrent(timesfc):
+    data = StringIO(urlopen('http://bergeron.valpo.edu/current_surface_data/'f'{timesfc:%Y%m%d%H}_sao.wmo').read().decode('utf-8', 'backslashreplace'))
+    return metar.parse_metar_file(data, year=timesfc.year, month=timesfc.month)
+
+def IEMRequest(start, end):
+    return pd.read_csv(f'http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?data=all&tz=Etc/UTC&format=comma&latlon=yes&year1={start.year}&month1={start.month}&day1={start.day}&hour1={start.hour}&minute1={start.minute}&year2={end.year}&month2={end.month}&day2={end.day}&hour2={end.hour}&minute2={end.minute}', skiprows=5, na_values=['M'], parse_dates=['valid'], low_memory=False).replace('T', 0.00001)
+
+# A map's IEM ASOS obs are the reports in the minute at its time. In a loop, the times that will need them are split
+# into chunks of at most iemChunk, with a new chunk wherever the times are further apart than iemGap; a map whose time
+# is in a chunk pulls the whole chunk the first time the IEM fallback is needed, through the surface cache, and takes
+# its minute from it.
+iemWindow = timedelta(minutes=1)
+iemChunk = timedelta(hours=6)
+iemGap = timedelta(hours=1)
+
+def IEMCurrent(timesfc, chunks=None):
+    chunk = [(start, end) for start, end in (chunks or []) if start <= timesfc <= end]
+    if len(chunk) > 0:
+        start, end = chunk[0]
+        cache = amgp.GetCache("surface", lambda sfcDat: int(sfcDat.memory_usage(deep=True).sum()))
+        iem = cache.Fetch(("iem_chunk", f"{start:%Y%m%d%H%M}", f"{end:%Y%m%d%H%M}"), lambda: IEMRequest(start, end + iemWindow).set_index('valid', drop=False).sort_index())
+        data = iem[(iem.index >= timesfc) & (iem.index < timesfc + iemWindow)].groupby('station').tail(1)
+    else:
+        data = IEMRequest(timesfc, timesfc + iemWindow).groupby('station').tail(1)
+    sfcDat = metar.parse_metar_file(StringIO('\n'.join(val for val in data.metar)), year=timesfc.year, month=timesfc.month)
+    sfcDat['date_time'] = timesfc
+    return sfcDat
+
+def SurfaceTime(Time):
+    if (Time.category == 'sync') or (Time.category == 'raw') or (Time.category == 'near'):
+        return Time.time
+    return Time.threetime
+
+# Called before a loop with each of its base times; plans the IEM chunks without pulling anything, since the IEM is
+# only asked when Valpo fails. The plan is the list of (start, end) chunks, which the loop's frames hand back.
+def PrefetchRange(Times, factors, values, LocalData=None):
+    if (LocalData != None) or (amgp.GetLevel(values['level']).level != 'surface'):
+        return None
+    chunks = []
+    for timesfc in sorted(set(SurfaceTime(Time) for Time in Times)):
+        if timesfc.year < 2019:
+            continue
+        if (len(chunks) > 0) and (timesfc - chunks[-1][1] <= iemGap) and (timesfc - chunks[-1][0] <= iemChunk):
+            chunks[-1] = (chunks[-1][0], timesfc)
+        else:
+            chunks.append((timesfc, timesfc))
+    return chunks
+
+# The 15-minute window of a day file that a map plots. Day files are kept whole, indexed by observation time, in the
+# surface cache, so that a loop over one day reads its file once and loops over different days do not trade one file.
+def ArchiveWindow(timesfc, window=timedelta(minutes=15)):
+    cache = amgp.GetCache("surface", lambda sfcDat: int(sfcDat.memory_usage(deep=True).sum()))
+    sfcDat = cache.Fetch(("valpo_archive_day", f"{timesfc:%Y%m%d}"), lambda: Parsed('valpo_archive', ValpoArchive, timesfc, '%Y%m%d').set_index('date_time', drop=False).sort_index())
+    return sfcDat.loc[timesfc - window:timesfc + window].reset_index(drop=True)
+
+# Surface sources in the order they are tried, as (name, loader, weather format)
+def SurfaceSources(timesfc, chunks=None):
+    if timesfc.year < 2019:
+        return [('valpo_archive', ArchiveWindow, 'present_weather')]
+    return [('valpo_current', lambda timesfc: Parsed('valpo_current', ValpoCurrent, timesfc, '%Y%m%d%H'), 'current_wx1_symbol'),
+            ('iem', lambda timesfc: Parsed('iem', lambda timesfc: IEMCurrent(timesfc, chunks), timesfc, '%Y%m%d%H%M'), 'current_wx1_symbol')]
+
+# Parsed surface obs are kept in memory and on disk by source and time, so that a rerun or a loop over the same hour
+# loads them instead of downloading and parsing METARs again; obs of the last few hours are only briefly reused.
+def Surface(timesfc, chunks=None):
+    cache = amgp.GetCache("surface", lambda sfcDat: int(sfcDat.memory_usage(deep=True).sum()))
+    for name, load, weather in SurfaceSources(timesfc, chunks):
+        try:
+            return cache.Fetch((name, f"{timesfc:%Y%m%d%H%M}", amgp.Freshness(timesfc)), lambda: load(timesfc)), weather
+        except:
+            continue
+    if timesfc.year < 2019:
+        print("(AMGP_OBS) <warning> Archive surface obs not found!")
+    else:
+        print("(AMGP_OBS) <warning> Recent surface obs not found!")
+    return None, None
+
+def Parsed(name, fetch, timesfc, span):
+    path = f"{amgp.CacheDir('surface')}/{name}_{timesfc:{span}}"
+    settled = amgp.Settled(timesfc)
+    if settled:
+        sfcDat = LoadFrame(path)
+        if sfcDat is not None:
+            return sfcDat
+    
+    sfcDat = fetch(timesfc)
+    sfcDat['tmpf'] = (sfcDat.air_temperature.values * units.degC).to('degF').m
+    sfcDat['dwpf'] = (sfcDat.dew_point_temperature.values * units.degC).to('degF').m
+    if settled:
+        StoreFrame(sfcDat, path)
+    return sfcDat
+
+# Every level of a cycle is plotted from one national sounding pull, located and checked once, and kept on disk once
+# the cycle is six hours old; before that, soundings may still be coming in
+def Soundings(timeua):
+    path = f"{amgp.CacheDir('upperair')}/{timeua:%Y%m%d%H}"
+    settled = amgp.Settled(timeua, 6)
+    if settled:
+        uaDat = LoadFrame(path)
+        if uaDat is not None:
+            return uaDat
+    
+    uaDat = IAStateUpperAir.request_all_data(timeua)
+    uaDat = add_station_lat_lon(uaDat, 'station').dropna(subset=['latitude', 'longitude'])
+    uaDat = uaDat[uaDat.station != 'KVER'] # "central Missouri" station that shouldn't be there, due to faulty lat-lon data
+    uaDat['dewpoint_depression'] = uaDat['temperature'] - uaDat['dewpoint']
+    if settled:
+        StoreFrame(uaDat, path)
+    return uaDat
+
+def LoadFrame(path):
+    for ext, read in [('parquet', pd.read_parquet), ('pkl', pd.read_pickle)]:
+        if os.path.isfile(f"{path}.{ext}"):
+            try:
+                frame = read(f"{path}.{ext}")
+                amgp.TouchDisk(f"{path}.{ext}")
+                return frame
+            except:
+                continue
+    return None
+
+# Parquet needs pyarrow or fastparquet; without either, or for columns it cannot hold, the frame is pickled instead
+def StoreFrame(frame, path):
+    try:
+        frame.to_parquet(f"{path}.parquet.tmp")
+        os.replace(f"{path}.parquet.tmp", f"{path}.parquet")
+        amgp.TrimDisk(f"{path}.parquet")
+    except:
+        try:
+            frame.to_pickle(f"{path}.pkl.tmp")
+            os.replace(f"{path}.pkl.tmp", f"{path}.pkl")
+            amgp.TrimDisk(f"{path}.pkl")
+        except:
+            print("(AMGP_OBS) <warning> Obs could not be written to the local cache")
@@ -10,8 +10,11 @@
 #                                              #
 ################################################
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
 from datetime import datetime, timedelta
-from io import StringIO
+from io import StringIO, BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.request import urlopen
 from siphon.simplewebservice.iastate import IAStateUpperAir
 from siphon.catalog import TDSCatalog
@@ -37,6 +40,11 @@ import json
 import glob
 import contextlib
 from importlib import import_module
+import time
+import threading
+import base64
+import socketserver
+import stat
 
 from tkinter import *
 from tkinter import ttk
@@ -55,28 +63,31 @@ from Modules import AMGP_UTIL as amgp
 
 #--------------- START DEFINITIONS ----------------#
 
+# Set by init for the menus; a run takes its own from extras when given
+area_dictionary = {}
+version = ""
+
 def info():
     return {'name':"AMGP_PLT",
             'uid':"00220100"}
 
+# Raised instead of going back to the menu when a map is made for another program, which has no menu to go back to
+class MapError(Exception):
+    def __init__(self, text, moduleName="AMGP_PLT"):
+        super().__init__(text)
+        self.moduleName = moduleName
+
+# A run that cannot go on reopens the menu, unless its settings were marked 'embedded' by Make or the daemon. Off the
+# main thread, as in RetrievePlots' workers, it raises instead, and the thread that started the run aborts in its place.
+def Abort(moduleName, text, values):
+    if values.get('embedded') or amgp.Mode('embedded') or (threading.current_thread() is not threading.main_thread()):
+        raise MapError(text, moduleName)
+    print(f"({moduleName}) <error> {text}")
+    inputChain()
+
 def init(pack, QRA=None):
-    global unpack
-    global area_dictionary
-    global version
-    global amgpmodules
     global noShow
-    global amgpmenumodules
-    global amgpcombomodules
-    global modules
-    unpack = pack
-
-    config = unpack['config']
-    area_dictionary = unpack['customareas']
-    version = unpack['ver']
-    modules = unpack['modulenames']
-    amgpmodules = unpack['datamods']
-    amgpmenumodules = unpack['menumods']
-    amgpcombomodules = unpack['combomods']
+    Unpack(pack)
 
     amgp.getTime()
     
@@ -94,37 +105,64 @@ def init(pack, QRA=None):
         inputChain()
     else:
         if QRA.startswith("{"):
-            QRA = json.loads(QRA)
-            for c, w in QRA.items():
-                for k, v in unpack['modulenames'].items():
-                    if c.upper() in v:
-                        QRA[c]["extras"]["amgpmodules"] = unpack["datamods"]
-                        for key, value in unpack['menumods'].items():
-                            if key == k:
-                                value.run(QRA[c]["values"], QRA[c]["extras"])
+            Dispatch(json.loads(QRA))
 
         if QRA.endswith(".txt"):
             with open(QRA, "r") as source:
                 for line in source:
-                    uline = json.loads(line)
-                    for c, w in uline.items():
-                        for k, v in unpack['modulenames'].items():
-                            if c.upper() in v:
-                                uline[c]["extras"]["amgpmodules"] = unpack["datamods"]
-                                for key, value in unpack['menumods'].items():
-                                    if key == k:
-                                        value.partialInit(unpack)
-                                        value.run(uline[c]["values"], uline[c]["extras"])
+                    Dispatch(json.loads(line), True)
 
         if QRA.endswith(".json"):
             with open(QRA, "r") as source:
-                dic = json.load(source)
-                for k, v in unpack['modulenames'].items():
-                    if dic["type"].upper() in v:
-                        for key, value in unpack['menumods'].items():
-                            if key == k:
-                                extras = {"amgpmodules": unpack["datamods"], "S": True, "noShow": True, "proj": "", "direct": True, "altDir": False, "altDirCon": False, "title": ""}
-                                value.run(dic["settings"], extras)
+                Dispatch(json.load(source))
+
+# Takes in what Main.py packed, for the menus and for runs started without them
+def Unpack(pack):
+    global unpack
+    global area_dictionary
+    global version
+    global amgpmodules
+    global amgpmenumodules
+    global amgpcombomodules
+    global modules
+    unpack = pack
+
+    config = unpack['config']
+    area_dictionary = unpack['customareas']
+    version = unpack['ver']
+    modules = unpack['modulenames']
+    amgpmodules = unpack['datamods']
+    amgpmenumodules = unpack['menumods']
+    amgpcombomodules = unpack['combomods']
+
+# Runs one quick-run job with the menu module it names: either {"plt": {"values": ..., "extras": ...}} and the like,
+# as batch files hold them, or a saved preset's {"type": ..., "settings": ...}. An embedded job raises MapError where a
+# batch run would go back to the menu.
+def Dispatch(job, partial=False, embedded=False):
+    if embedded:
+        for settings in [job.get("settings")] + [w.get("values") for w in job.values() if type(w) == dict]:
+            if type(settings) == dict:
+                settings = settings.get("OBS", settings)
+                settings['embedded'] = True
+        with amgp.Modes(embedded=True):
+            return Dispatch(job, partial)
+    if "type" in job:
+        for k, v in unpack['modulenames'].items():
+            if job["type"].upper() in v:
+                for key, value in unpack['menumods'].items():
+                    if key == k:
+                        extras = {"amgpmodules": unpack["datamods"], "S": True, "noShow": True, "proj": "", "direct": True, "altDir": False, "altDirCon": False, "title": ""}
+                        value.run(job["settings"], extras)
+        return
+    for c, w in job.items():
+        for k, v in unpack['modulenames'].items():
+            if c.upper() in v:
+                job[c]["extras"]["amgpmodules"] = unpack["datamods"]
+                for key, value in unpack['menumods'].items():
+                    if key == k:
+                        if partial:
+                            value.partialInit(unpack)
+                        value.run(job[c]["values"], job[c]["extras"])
 
 def partialInit(pack):
     global unpack
@@ -157,6 +195,8 @@ def inputChain():
         print("(AMGP_PLT) <list> Type 'edit Factors {(optional) add/remove} {value}' to edit loaded factors.")
         print("(AMGP_PLT) <list> Type 'save {preset name}' to save the current settings as a preset.")
         print("(AMGP_PLT) <list> Type 'run' to run with the current settings.")
+        print("(AMGP_PLT) <list> Type 'cache stats' to see how much data is cached in memory and on disk.")
+        print("(AMGP_PLT) <list> Type 'cache purge' to empty the memory and disk caches.")
         print("(AMGP_PLT) <list> Type 'switch {module}' to change to a different menu module.")
         print("(AMGP_PLT) <list> Type 'quit' to exit without running.")
         inputChain()
@@ -196,7 +236,7 @@ def inputChain():
     elif command[0] == 'edit':
         if command[1] in ["Level", "Date", "Delta", "Factors", "Area", "DPI", "Scale", "PRF", "BF", "Smooth", "Projection", "TM", "CM", "LDS"]:
             if command[1] == "Level":
-                loaded.update({'level':command[2]})
+                loaded.update({'level':", ".join(item.strip(",") for item in command[2:])})
             if command[1] == "Date":
                 if command[2] == 'recent':
                     loaded.update({'date':command[2]})
@@ -236,7 +276,7 @@ def inputChain():
                 fullFactors = ', '.join(blankFactors)
                 loaded.update({'factors':fullFactors})
             if command[1] == "Area":
-                loaded.update({'area':command[2]})
+                loaded.update({'area':", ".join(item.strip(",") for item in command[2:])})
             if command[1] == "DPI":
                 loaded.update({'dpi':command[2]})
             if command[1] == "Scale":
@@ -313,6 +353,15 @@ def inputChain():
         print("(AMGP_PLT) <error> That is not a valid module to switch to!")
         inputChain()
     
+    elif command[0] == 'cache':
+        if (len(command) > 1) and (command[1] == 'stats'):
+            amgp.PrintCacheStats()
+        elif (len(command) > 1) and (command[1] == 'purge'):
+            amgp.PurgeCaches()
+            print("(AMGP_PLT) <cache> The memory and disk caches were emptied.")
+        else:
+            print("(AMGP_PLT) <error> Type 'cache stats' or 'cache purge'.")
+        inputChain()
     elif command[0] == 'ping':
         amgp.getPing(amgp.setTime(), amgpmodules.values())
         inputChain()
@@ -397,25 +446,151 @@ def RetrievePlots(values, Time, amgpmodules, reformLD):
     congPlotType = PullFactors(values, amgpmodules)[0]
     
     plotslist = []
+    jobs = []
     
     for module in amgpmodules.values():
-        var = f"{module}".strip("amgp")
-        globals()[f"{var}"] = []
-        
-        for factor in factors:
-            if factor in module.getFactors().keys():
-                globals()[f"{var}"].append(factor)
-        
-        if len(globals()[f"{var}"]) > 0:
-            plotslist.extend(module.Retrieve(Time, globals()[f"{var}"], values, reformLD))
+        modFactors = [factor for factor in factors if factor in module.getFactors().keys()]
+        if len(modFactors) > 0:
+            jobs.append((module, modFactors))
+    
+    if len(jobs) == 0:
+        return plotslist
+    if len(jobs) == 1:
+        module, modFactors = jobs[0]
+        return module.Retrieve(Time, modFactors, values, reformLD)
+    
+    # The modules are I/O bound, so they all retrieve at once; their plots are still stacked in priority order. A module
+    # that fails stops the map as it would have retrieving alone, only once the others are in.
+    timeouts = amgp.Config().get('retrieve', {}).get('timeout_s', {})
+    pool = ThreadPoolExecutor(max_workers=len(jobs))
+    started = time.monotonic()
+    futures = [pool.submit(amgp.Carried(module.Retrieve), Time, modFactors, values, reformLD) for module, modFactors in jobs]
+    failure = None
+    try:
+        for (module, modFactors), future in zip(jobs, futures):
+            name = module.__name__.split('.')[-1]
+            timeout = float(timeouts.get(name, timeouts.get('default', 300)))
+            try:
+                plotslist.extend(future.result(timeout=max(started + timeout - time.monotonic(), 0)))
+            except FutureTimeout:
+                print(f"(AMGP_PLT) <warning> {name} took longer than {timeout:.0f} seconds and was left off the map")
+            except Exception as error:
+                if failure is None:
+                    failure = error
+    finally:
+        pool.shutdown(wait=False)
+    
+    if isinstance(failure, MapError):
+        Abort(failure.moduleName, str(failure), values)
+    elif failure is not None:
+        raise failure
     
     return plotslist
     
     
-# The meat of the program
+def ReformLD(values):
+    avLD = amgp.LocalData()
+    reformLD = {}
+    for num in values['LDS'].split(", "):
+        if int(num) != 0:
+            reformLD[avLD[int(num)][0]] = avLD[int(num)][1]
+
+    if reformLD == {}:
+        reformLD = None
+    return reformLD
+
+# A level setting may list several levels, e.g. "850, 700, 500". Each level becomes its own map, and each map's values
+# carry the whole list as 'levels' so that data modules can fetch what the maps share once.
+def Levels(values):
+    levels = [level.strip() for level in str(values['level']).split(',')]
+    if len(levels) == 1:
+        return [values]
+    split = []
+    for level in levels:
+        levelValues = dict(values)
+        levelValues['level'] = level
+        levelValues['levels'] = [amgp.GetLevel(item).level for item in levels]
+        split.append(levelValues)
+    return split
+
+# The values for each area of a multi-area setting, which are all drawn from the same plots
+def Areas(values, areas=None):
+    if areas == None:
+        areas = area_dictionary
+    names = [area.strip() for area in str(values['area']).split(',')]
+    if len(names) == 1:
+        return [values]
+    split = []
+    for area in names:
+        areaValues = dict(values)
+        areaValues['area'] = area
+        areaValues['extent'] = amgp.ParseArea(area, areas)
+        split.append(areaValues)
+    return split
+
+# Lets data modules that can pull several forecast hours at once do so before a loop makes its maps one by one
+def Prefetch(values, extras, deltas):
+    if len(Levels(values)) > 1:
+        for levelValues in Levels(values):
+            Prefetch(levelValues, extras, deltas)
+        return
+    
+    amgpmodules = extras["amgpmodules"]
+    values = dict(values)
+    values['level'] = amgp.GetLevel(values['level']).level
+    values['extent'] = amgp.UnionArea(values['area'], extras.get("areas", area_dictionary))
+    
+    Time = amgp.ParseTime(values['date'], PullFactors(values, amgpmodules)[0], extras.get("now", amgp.setTime()), values['timemode'], values['convmode'])
+    reformLD = ReformLD(values)
+    
+    factors = values['factors'].split(', ')
+    for module in amgpmodules.values():
+        modFactors = [factor for factor in factors if factor in module.getFactors().keys()]
+        if (len(modFactors) > 0) and hasattr(module, 'Prefetch'):
+            try:
+                module.Prefetch(Time, modFactors, values, deltas, reformLD)
+            except:
+                print(f"(AMGP_PLT) <warning> {module.__name__.split('.')[-1]} could not prefetch; its maps will be fetched one by one")
+
+# Lets data modules that can pull many of a loop's base dates at once plan those pulls before the loop starts. What
+# each module plans comes back by module name, for the loop to hand to its frames as values['plans'].
+def PrefetchRange(values, extras, dates):
+    plans = {}
+    if len(Levels(values)) > 1:
+        for levelValues in Levels(values):
+            plans.update(PrefetchRange(levelValues, extras, dates))
+        return plans
+    
+    amgpmodules = extras["amgpmodules"]
+    values = dict(values)
+    values['level'] = amgp.GetLevel(values['level']).level
+    
+    plotTypes = PullFactors(values, amgpmodules)[0]
+    now = extras.get("now", amgp.setTime())
+    Times = [amgp.ParseTime(date, plotTypes, now, values['timemode'], values['convmode']) for date in dates]
+    reformLD = ReformLD(values)
+    
+    factors = values['factors'].split(', ')
+    for module in amgpmodules.values():
+        modFactors = [factor for factor in factors if factor in module.getFactors().keys()]
+        if (len(modFactors) > 0) and hasattr(module, 'PrefetchRange'):
+            name = module.__name__.split('.')[-1]
+            try:
+                plan = module.PrefetchRange(Times, modFactors, values, reformLD)
+                if plan is not None:
+                    plans[name] = plan
+            except:
+                print(f"(AMGP_PLT) <warning> {name} could not prefetch; its maps will be fetched one by one")
+    return plans
+
+# The meat of the program. A run works on its own copy of values and takes the areas, version and time it works to from
+# extras, falling back to what init was given, so several runs can go on at once in one process.
 def run(values, extras):
 
+    values = dict(values)
     amgpmodules = extras["amgpmodules"]
+    areas = extras.get("areas", area_dictionary)
+    mapVersion = extras.get("version", version)
     S = extras["S"]
     noShow = extras["noShow"]
     proj = extras["proj"]
@@ -424,7 +599,14 @@ def run(values, extras):
     altDirCon = extras["altDirCon"]
     title = extras["title"]
     
-    currentTime = amgp.setTime()
+    currentTime = extras.get("now", amgp.setTime())
+    
+    # Several levels, one map each
+    if len(Levels(values)) > 1:
+        results = [run(levelValues, dict(extras, now=currentTime)) for levelValues in Levels(values)]
+        if not direct:
+            return results
+        return
 
     '''
     rewind = 0
@@ -447,26 +629,172 @@ def run(values, extras):
     level = amgp.GetLevel(values['level']).level
     values['level'] = level
         
+    # Area, so that data modules can pull only what the map(s) show
+    values['extent'] = amgp.UnionArea(values['area'], areas)
+        
     # Date
     Time = amgp.ParseTime(values['date'], PullFactors(values, amgpmodules)[0], currentTime, values['timemode'], values['convmode'])
 
     #Setting up local data
-    avLD = amgp.LocalData()
-    reformLD = {}
-    for num in values['LDS'].split(", "):
-        if int(num) != 0:
-            reformLD[avLD[int(num)][0]] = avLD[int(num)][1]
-
-    if reformLD == {}:
-        reformLD = None
+    reformLD = ReformLD(values)
     
     # Data
     plotslist = RetrievePlots(values, Time, amgpmodules, reformLD)
 
     if direct:
-        amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, values, area_dictionary, amgpmodules, title, version), S, noShow, proj, altDir, altDirCon)
+        for areaValues in Areas(values, areas):
+            amgpmap.SaveMap(amgpmap.Panel(Time, plotslist, areaValues, areas, amgpmodules, title, mapVersion), S, noShow, proj, altDir, altDirCon)
     else:
         return Time, plotslist, values
 
 
+# The data modules, in priority order, found the way Main.py finds them; for callers that do not go through Main.py
+def DataModules():
+    found = {}
+    for module in os.listdir(os.path.dirname(os.path.realpath(__file__))):
+        if module.startswith("AMGP_") and module.endswith(".py"):
+            mod = import_module(f'Modules.{module.replace(".py", "")}')
+            uid = mod.info()['uid']
+            if int(uid[3:-4]) == 1:
+                found[int(uid[4:])] = mod
+    return dict(sorted(found.items()))
+
+# Makes the maps for a settings dict, as a plot.json "settings" block holds them, and hands them back instead of saving
+# them: a list of (image, metadata) with one entry per level and area. form is "png", "jpeg" or "webp" for encoded
+# bytes, "rgba" for an array of shape (height, width, 4), or "image" for the PIL image. Nothing is printed, nothing
+# is written to Maps, and the menus' globals are not needed, so it is safe to call from other programs and threads.
+# Where a menu run would go back to the menu, MapError is raised; a date that cannot be mapped raises ValueError.
+# Settings left out come from the default plot preset. The data modules, areas and version default to those init was
+# given, or else to those in the Modules folder and config.json.
+def Make(values, form="png", title='', reuse=False, now=None, amgpmodules=None, areas=None, version=None):
+    if amgpmodules == None:
+        amgpmodules = globals().get('amgpmodules') or DataModules()
+    if areas == None:
+        areas = area_dictionary or {k: tuple(map(float, v.split(", "))) for k, v in amgp.Config()['areas'].items()}
+    if version == None:
+        version = globals()['version'] or amgp.Config()['config_ver']
+    
+    dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Presets")
+    with open(f"{dr}/plot/default.json", "r") as J:
+        values = dict(json.load(J)["settings"], **values)
+    values['embedded'] = True
+    
+    if form not in ("png", "jpeg", "webp", "rgba", "image"):
+        raise ValueError(f"Unknown image form '{form}'")
+    for area in str(values['area']).split(','):
+        if type(amgp.ParseArea(area.strip(), areas)) != tuple:
+            try:
+                declarative.MapPanel().area = area.strip()
+            except:
+                raise ValueError(f"The area '{area.strip()}' does not exist")
+    
+    extras = {"amgpmodules": amgpmodules, "S": True, "noShow": True, "proj": '', "direct": False, "title": title,
+              "altDir": False, "altDirCon": False, "areas": areas, "version": version, "now": now if now != None else amgp.setTime()}
+    made = []
+    with amgp.Modes(quiet=True, embedded=True):
+        results = run(values, extras)
+        if type(results) != list:
+            results = [results]
+        for Time, plotslist, levelValues in results:
+            for areaValues in Areas(levelValues, areas):
+                product = amgpmap.Panel(Time, plotslist, areaValues, areas, amgpmodules, title, version)
+                image = amgpmap.Image(product, reuse)
+                if image is None:
+                    continue
+                meta = amgpmap.Describe(product)
+                meta['size'] = image.size
+                if form == "image":
+                    made.append((image, meta))
+                elif form == "rgba":
+                    made.append((np.asarray(image), meta))
+                else:
+                    buffer = BytesIO()
+                    if form == "jpeg":
+                        image.convert('RGB').save(buffer, format=form, quality=90)
+                    else:
+                        image.save(buffer, format=form)
+                    meta['name'] = f"{meta['name'][:-4]}.{form}"
+                    made.append((buffer.getvalue(), meta))
+    return made
+
+
+# The daemon. Main.py hands over its pack and an address once, and every job after that finds the modules imported,
+# the shapefiles loaded and the data caches warm. An address that is a number is a port on localhost; anything else is
+# the path of a Unix socket. Jobs are POSTed as JSON in the quick-run shapes Dispatch takes. A job that also has a
+# "form" ("png", "jpeg", "webp") must be a plt job, and its maps come back base64-encoded, with their metadata and
+# nothing saved; any other job is run as a batch line would be, and the paths of the maps it saved come back.
+def Serve(pack, address):
+    Unpack(pack)
+    imports(unpack)
+    
+    class Handler(BaseHTTPRequestHandler):
+        def Reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_GET(self):
+            self.Reply(200, {"amgp_ver": version, "modules": list(modules.values())})
+        
+        def do_POST(self):
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except:
+                self.Reply(400, {"error": "The job is not valid JSON"})
+                return
+            try:
+                if "form" in job:
+                    if job["form"] not in ("png", "jpeg", "webp"):
+                        raise ValueError(f"Unknown image form '{job['form']}'")
+                    settings = job["plt"]["values"] if "plt" in job else job["settings"]
+                    title = job.get("plt", {}).get("extras", {}).get("title", '')
+                    maps = Make(settings, job["form"], title)
+                    self.Reply(200, {"maps": [{"image": base64.b64encode(image).decode(), "meta": meta} for image, meta in maps]})
+                else:
+                    amgpmap.saved.paths = []
+                    try:
+                        Dispatch(job, True, True)
+                        paths = amgpmap.saved.paths
+                    finally:
+                        amgpmap.saved.paths = None
+                    self.Reply(200, {"paths": paths})
+            except MapError as error:
+                self.Reply(422, {"error": f"{error}"})
+            except (ValueError, KeyError) as error:
+                self.Reply(400, {"error": f"{type(error).__name__}: {error}"})
+            except:
+                self.Reply(500, {"error": f"{sys.exc_info()[0].__name__}: {sys.exc_info()[1]}"})
+        
+        def log_message(self, format, *args):
+            print(f"(AMGP_PLT) <serve> {self.command} {self.path}: {format % args}")
+    
+    if str(address).isdigit():
+        server = ThreadingHTTPServer(("127.0.0.1", int(address)), Handler)
+        print(f"(AMGP_PLT) <serve> Taking jobs at http://127.0.0.1:{address}")
+    else:
+        class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+        # Only a stale socket is cleared away; any other file at the path is left alone
+        if os.path.lexists(address):
+            if not stat.S_ISSOCK(os.lstat(address).st_mode):
+                print(f"(AMGP_PLT) <error> {address} exists and is not a socket; give the daemon another address")
+                return
+            os.remove(address)
+        server = UnixServer(address, Handler)
+        print(f"(AMGP_PLT) <serve> Taking jobs at {address}")
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("(AMGP_PLT) <serve> Stopping")
+    finally:
+        server.server_close()
+        if (not str(address).isdigit()) and os.path.lexists(address) and stat.S_ISSOCK(os.lstat(address).st_mode):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(address)
+
+
 # --- End Definitions ---
\ No newline at end of file
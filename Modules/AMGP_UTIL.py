@@ -11,9 +11,13 @@
 ################################################
 
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import math
 import sys
 import os
+import json
+import threading
+import time
 import contextlib
 from PIL import Image as PImage
 from PIL import ImageDraw, ImageFont, ImageFilter
@@ -359,10 +363,78 @@ class Levels(object):
 def GetLevel(lvlstring):
     return Levels(lvlstring)
 
+# Parses an area name, with its '+'/'-' zoom, into (west, east, south, north).
+# Areas not found in the area dictionary are returned as given.
+def ParseArea(area, area_dictionary):
+    simArea = area.replace("+", "")
+    simArea = simArea.replace("-", "")
+    if simArea in area_dictionary:
+        factor = area.count('+') - area.count('-')
+        scaleFactor = (1 - 2**-factor)/2
+        west, east, south, north = area_dictionary[f'{simArea}']
+        newWest = west - (west - east) * scaleFactor
+        newEast = east + (west - east) * scaleFactor
+        newSouth = south - (south - north) * scaleFactor
+        newNorth = north + (south - north) * scaleFactor
+        return newWest, newEast, newSouth, newNorth
+    return area
+
+# An area setting may list several areas, e.g. "USc, MW, LSS"; data is pulled once for the area covering all of them.
+def UnionArea(area, area_dictionary):
+    areas = [ParseArea(item.strip(), area_dictionary) for item in str(area).split(',')]
+    if len(areas) == 1:
+        return areas[0]
+    if any(type(item) != tuple for item in areas):
+        return None
+    return min(item[0] for item in areas), max(item[1] for item in areas), min(item[2] for item in areas), max(item[3] for item in areas)
+
+# Pads a parsed area by a fixed number of degrees into the region data should be pulled for, as ((south, north),
+# (west, span)) with the span measured eastward from west; the longitudes are None when the padded area circles the globe.
+def DataArea(area, pad=5):
+    west, east, south, north = area
+    lats = (min(south, north) - pad, max(south, north) + pad)
+    span = (east - west) % 360
+    if span + 2 * pad >= 360:
+        return lats, None
+    return lats, (west - pad, span + 2 * pad)
+
+# The runs of consecutive True values in a 1-D mask, as slices
+def Runs(mask):
+    runs = []
+    start = None
+    for i, inside in enumerate(mask):
+        if inside and (start is None):
+            start = i
+        elif (not inside) and (start is not None):
+            runs.append(slice(start, i))
+            start = None
+    if start is not None:
+        runs.append(slice(start, len(mask)))
+    return runs
+
+# Which of the given points fall in a parsed area, padded on every side by a fraction of its size so that points near
+# the edges of a projected map are kept. Works on anything that supports arithmetic and comparisons, like a pandas Series.
+def InArea(lat, lon, area, pad=0.25):
+    west, east, south, north = area
+    latPad = abs(north - south) * pad
+    span = (east - west) % 360
+    lonPad = span * pad
+    return (lat >= min(south, north) - latPad) & (lat <= max(south, north) + latPad) & ((lon - west + lonPad) % 360 <= span + 2 * lonPad)
+
 def setTime():
     currentTime = datetime.utcnow()
     return currentTime
     
+# Obs for a time this recent may still be filling in as reports arrive, so they are never kept on disk, and in memory
+# are only reused within the same few minutes: Freshness is None for settled times, or else the current slot.
+def Settled(time, hours=3):
+    return datetime.utcnow() - time > timedelta(hours=hours)
+
+def Freshness(time, hours=3, minutes=10):
+    if Settled(time, hours):
+        return None
+    return int(datetime.utcnow().timestamp() // (minutes * 60))
+
 def getTime():
     currentTime = datetime.utcnow()
     print(f"(AMGP_UTIL) <time> It is currently {currentTime}Z")
@@ -378,56 +450,83 @@ def ClearTemp():
             with contextlib.suppress(FileNotFoundError):
                 os.remove(f"{dr}/Temp/{subPath}")
 
+# Per-thread run modes. 'quiet' keeps a thread's printing off stdout without touching any other thread's, and
+# 'embedded' makes errors that would log, exit or go back to the menu raise instead. Modes nest, and Carried hands the
+# current thread's modes on to work it gives to other threads.
+modes = threading.local()
+
+class QuietStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def write(self, text):
+        if Mode('quiet'):
+            return len(text)
+        return self.stream.write(text)
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def Mode(name):
+    return getattr(modes, name, False)
+
+@contextlib.contextmanager
+def Modes(**given):
+    if not isinstance(sys.stdout, QuietStream):
+        sys.stdout = QuietStream(sys.stdout)
+    before = {name: Mode(name) for name in given}
+    for name, value in given.items():
+        setattr(modes, name, value)
+    try:
+        yield
+    finally:
+        for name, value in before.items():
+            setattr(modes, name, value)
+
+def Quiet():
+    return Modes(quiet=True)
+
+def Carried(func):
+    given = dict(vars(modes))
+    def carried(*args, **kwargs):
+        with Modes(**given):
+            return func(*args, **kwargs)
+    return carried
+
+# The logo as each watermark form draws it, by (form, size), so that it is only opened, resized and faded once
+logos = {}
+logoLock = threading.Lock()
+
+def Logo(form, sz):
+    with logoLock:
+        if (form, sz) not in logos:
+            dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "")
+            wm = PImage.open(f'{dr}/Resources/logo.png').convert('RGBA').resize(sz)
+            if form == 0:
+                bands = list(wm.split())
+                bands[3] = bands[3].point([int(x*0.05) for x in range(256)])
+                wm = PImage.merge(wm.mode, bands)
+            logos[(form, sz)] = wm
+        return logos[(form, sz)]
+
 def Watermark(save, version, form):
+    wid, hei = save.size
     if form == 0:
-        wid, hei = save.size
-        if wid > hei:
-            sz = (int(hei * 0.8), int(hei * 0.8))
-        if hei > wid:
-            sz = (int(wid * 0.8), int(wid * 0.8))
-        sz1, sz2 = sz
-        dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "")
-        wm = PImage.open(f'{dr}/Resources/logo.png')
-        wm = wm.convert('RGBA').resize(sz)
-        bands = list(wm.split())
-        if len(bands) == 4:
-            bands[3] = bands[3].point(lambda x: x*0.05)
-        wm = PImage.merge(wm.mode, bands)
-        left = int((wid-sz1) / 2)
-        top = int((hei-sz1) / 2)
-        save.paste(wm, (left, top), wm)
-        
-    if form == 1:
-        wid, hei = save.size
-        if wid > hei:
-            sz = (int(hei * 0.1), int(hei * 0.1))
-        if hei > wid:
-            sz = (int(wid * 0.1), int(wid * 0.1))
-        sz1, sz2 = sz
-        dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "")
-        wm = PImage.open(f'{dr}/Resources/logo.png')
-        wm = wm.convert('RGBA').resize(sz)
-        bands = list(wm.split())
-        wm = PImage.merge(wm.mode, bands)
+        sz = (int(min(wid, hei) * 0.8), int(min(wid, hei) * 0.8))
+        left = int((wid-sz[0]) / 2)
+        top = int((hei-sz[0]) / 2)
+    elif form == 1:
+        sz = (int(min(wid, hei) * 0.1), int(min(wid, hei) * 0.1))
         left = int(wid * 0.01)
         top = int(hei * 0.85)
-        save.paste(wm, (left, top), wm)
-        
-    if form == 2:
-        wid, hei = save.size
-        if wid > hei:
-            sz = (int(hei * 0.1), int(hei * 0.1))
-        if hei > wid:
-            sz = (int(wid * 0.1), int(wid * 0.1))
-        sz1, sz2 = sz
-        dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "")
-        wm = PImage.open(f'{dr}/Resources/logo.png')
-        wm = wm.convert('RGBA').resize(sz)
-        bands = list(wm.split())
-        wm = PImage.merge(wm.mode, bands)
+    elif form == 2:
+        sz = (int(min(wid, hei) * 0.1), int(min(wid, hei) * 0.1))
         left = int(wid * 0.89)
         top = int(hei * 0.89)
-        save.paste(wm, (left, top), wm)
+    else:
+        return save
+    wm = Logo(form, sz)
+    save.paste(wm, (left, top), wm)
     return save
 
 
@@ -486,18 +585,220 @@ def ThrowError(moduleName, type, text, log=True, exit=False, echo=False):
     elif type == 2:
         Type = "alert"
     
+    # Embedded callers get the error back instead of a log file or the end of their process
+    if Mode('embedded'):
+        if (type == 0) or exit:
+            raise ValueError(text)
+        return
+    
     if echo:
         print(f"(AMGP_UTIL) <{Type}> {moduleName} threw '{text}'")
         
     if log:
         dr = os.path.dirname(os.path.realpath(__file__)).replace("Modules", "Logs")
-        with open(f"{dr}/ErrorLogs/{runtime.replace(microsecond=0)}.log", "a+") as logfile:
-            logfile.write(f"{moduleName} produced code {type} at {datetime.utcnow()}: " + text + "\n")
+        try:
+            os.makedirs(f"{dr}/ErrorLogs", exist_ok=True)
+            with open(f"{dr}/ErrorLogs/{runtime.replace(microsecond=0)}.log", "a+") as logfile:
+                logfile.write(f"{moduleName} produced code {type} at {datetime.utcnow()}: " + text + "\n")
+        except OSError:
+            print(f"(AMGP_UTIL) <warning> Could not write to the error log")
 
     if exit:
         sys.exit()
 
 
+def Config():
+    global config
+    try:
+        return config
+    except NameError:
+        with open(f"{os.path.dirname(os.path.realpath(__file__))}/../config.json", "r") as cfg:
+            config = json.load(cfg)
+        return config
+
+# A process-wide, least-recently-used store with a memory budget in bytes.
+# Entries are sized with the given sizer; the most recent entry is always kept, even if it alone exceeds the budget.
+class Cache(object):
+    def __init__(self, name, budget, sizer=None):
+        self.name = name
+        self.budget = budget
+        if sizer == None:
+            sizer = lambda value: getattr(value, 'nbytes', 0)
+        self.sizer = sizer
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.keyLocks = {}
+    
+    # Holds one key while its value is made or filled in, so that two callers never build the same entry. The
+    # cache-wide lock is only held for bookkeeping, never while a value is being made, so other keys go on meanwhile.
+    @contextlib.contextmanager
+    def Locked(self, key):
+        with self.lock:
+            if key not in self.keyLocks:
+                self.keyLocks[key] = [threading.RLock(), 0]
+            entry = self.keyLocks[key]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.keyLocks[key]
+    
+    def Get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return None
+    
+    def Put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.Drop(key)
+            try:
+                size = int(self.sizer(value))
+            except:
+                size = 0
+            self.items[key] = value
+            self.sizes[key] = size
+            self.used += size
+            while (self.used > self.budget) and (len(self.items) > 1):
+                self.Drop(next(iter(self.items)))
+            return value
+    
+    def Fetch(self, key, make, valid=None):
+        with self.Locked(key):
+            value = self.Get(key)
+            if value is None:
+                value = make()
+                if (valid == None) or valid(value):
+                    self.Put(key, value)
+            return value
+    
+    def Drop(self, key):
+        with self.lock:
+            if key in self.items:
+                del self.items[key]
+                self.used -= self.sizes.pop(key)
+    
+    def Clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.used = 0
+    
+    def Stats(self):
+        return {'name':self.name, 'entries':len(self.items), 'used':self.used, 'budget':self.budget, 'hits':self.hits, 'misses':self.misses}
+
+caches = {}
+cacheLock = threading.Lock()
+
+# config.json's cache.memory_mb is the budget for all the caches together; each cache gets its share of it from
+# cache.shares, and a cache not listed there gets the 'default' share
+shares = {'gridded': 0.5, 'basemaps': 0.15, 'surface': 0.15, 'soundings': 0.1, 'handles': 0.05, 'stations': 0.05, 'default': 0.05}
+
+def GetCache(name, sizer=None):
+    with cacheLock:
+        if name not in caches:
+            cfg = Config().get('cache', {})
+            split = dict(shares, **cfg.get('shares', {}))
+            budget = int(float(cfg.get('memory_mb', 2048)) * float(split.get(name, split['default'])) * 1024**2)
+            caches[name] = Cache(name, budget, sizer)
+        return caches[name]
+
+
+# The on-disk cache lives under config.json's cache.dir (relative to AMGP unless absolute), one folder per kind of data.
+def CacheDir(name=None):
+    dr = Config().get('cache', {}).get('dir', 'Cache')
+    if not os.path.isabs(dr):
+        dr = f"{os.path.dirname(os.path.realpath(__file__))}/../{dr}"
+    if name != None:
+        dr = f"{dr}/{name}"
+    os.makedirs(dr, exist_ok=True)
+    return dr
+
+# Cache files, as (last use, size, path). In-flight '.tmp' writes and '.json' indexes, like the gridded archive index,
+# are not cache entries and are never evicted.
+def DiskFiles():
+    files = []
+    for root, dirs, names in os.walk(CacheDir()):
+        for name in names:
+            if name.endswith('.tmp') or name.endswith('.json'):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                path = f"{root}/{name}"
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+    return files
+
+# The cache files as this process knows them, by path, so that a store does not walk the whole tree; filled by one walk
+# the first time it is needed, then kept up to date by TrimDisk and TouchDisk
+disk = {'files':None}
+diskLock = threading.Lock()
+
+def KnownDisk():
+    if disk['files'] is None:
+        disk['files'] = {path: (mtime, size) for mtime, size, path in DiskFiles()}
+    return disk['files']
+
+# Marks a cache file as just used, for files that are read back
+def TouchDisk(path):
+    with contextlib.suppress(OSError):
+        os.utime(path)
+        with diskLock:
+            files = KnownDisk()
+            if path in files:
+                files[path] = (time.time(), files[path][1])
+
+# Records the file just stored, then evicts the least-recently-used cache files until the cache is under config.json's
+# cache.disk_mb.
+def TrimDisk(path=None):
+    budget = int(Config().get('cache', {}).get('disk_mb', 10240)) * 1024**2
+    with diskLock:
+        files = KnownDisk()
+        if path != None:
+            with contextlib.suppress(OSError):
+                files[path] = (os.path.getmtime(path), os.path.getsize(path))
+        used = sum(size for mtime, size in files.values())
+        if used <= budget:
+            return
+        for mtime, size, old in sorted((mtime, size, old) for old, (mtime, size) in files.items()):
+            if used <= budget:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(old)
+            del files[old]
+            used -= size
+
+def PurgeDisk():
+    with diskLock:
+        for mtime, size, path in DiskFiles():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        disk['files'] = None
+
+def PrintCacheStats():
+    for cache in caches.values():
+        stats = cache.Stats()
+        print(f"(AMGP_UTIL) <cache> {stats['name']}: {stats['entries']} entries, {stats['used'] / 1024**2:.1f} of {stats['budget'] / 1024**2:.0f} MB, {stats['hits']} hits, {stats['misses']} misses")
+    files = DiskFiles()
+    budget = int(Config().get('cache', {}).get('disk_mb', 10240))
+    print(f"(AMGP_UTIL) <cache> disk ({CacheDir()}): {len(files)} files, {sum(file[1] for file in files) / 1024**2:.1f} of {budget} MB")
+
+def PurgeCaches():
+    for cache in caches.values():
+        cache.Clear()
+    PurgeDisk()
+
+
 def ArcDist(lat1, lon1, lat2, lon2):
     radius = 6378100
     delX = math.cos(math.radians(lat2)) * math.cos(math.radians(lon2)) - math.cos(math.radians(lat1)) * math.cos(math.radians(lon1))